@@ -3,3 +3,11 @@
 # esp.osdebug(None)
 # import webrepl
 # webrepl.start()
+
+# Import the app modules from the precompiled bundle if it matches the sources.
+try:
+    import mpybundle
+
+    mpybundle.activate()
+except Exception as e:
+    print("Could not check the precompiled bundle:", e)
@@ -6,37 +6,89 @@ Author: Gijs Mos, Sensemakers Amsterdam based on the original code by Karijn Wes
 Maintainer: Sensemakers Amsterdam  https://sensemakersams.org
 
 Functions:
-- mqtt_register_callback(topic, callback): Register a callback for a topic.
+- mqtt_register_callback(topic, callback): Register a callback for a topic, which may contain wildcards.
+- mqtt_sub_topic(): Return the sub-topic of the message being handled, in a callback.
 - mqtt_connect(clean_session=True): Connects to the MQTT broker using the provided settings.
 - mqtt_poll(): Polls the MQTT client for incoming messages.
-- mqtt_publish(sub_topic, msg, main_topic=None, retain=False): Publishes a message to the MQTT broker.
+- mqtt_publish(sub_topic, msg, main_topic=None, retain=False, qos=0): Publishes a message to the MQTT broker.
 - mqtt_connected(): Checks if the MQTT client is connected.
+- mqtt_stats(): Return a dict with the MQTT connection state and counters.
 - is_wifi_connected(): Check the connectivity status of the device.
-- wifi_connect(reconnect=False): Connects to a WiFi network or starts an access point if no network is available.
-- ntp_sync_time(): Synchronizes the system time with an NTP server.
+- wifi_start(reconnect=False): Start connecting to WiFi without waiting, see wifi_poll().
+- wifi_poll(): Advance the WiFi connection and return the WiFi state.
+- wifi_state(): Return the WiFi state.
+- wifi_stats(): Return a dict with the WiFi state and connection metrics.
+- wifi_set_callback(callback): Set the function called on WiFi state changes.
+- wifi_connect(reconnect=False, idle=None): Connects to a WiFi network or starts an access point if no network is available.
+- ntp_sync_time(idle=None, tries=3): Synchronizes the system time with an NTP server.
+
+The functions that wait for the network take an optional idle(ms) function that is called instead
+of sleeping, e.g. to keep rendering effect frames while connecting.
+
+WiFi is managed by a state machine that does not wait for the network: wifi_start() begins with
+the first station in the wifi_stations setting, and wifi_poll(), called regularly from the main
+loop, moves on to the next station when one fails or times out, falls back to an access point when
+none connects, and starts over when an established station connection is lost. The states are
+WIFI_IDLE, WIFI_CONNECTING, WIFI_STA and WIFI_AP.
+
+With the wifi_scan setting on, the stations are not tried in the order of the settings. The last
+network connected to is tried first, on the access point (BSSID) it was connected to, as saved in
+WIFI_CACHE_FILE. When that fails, the networks are scanned once, and the configured networks in
+range are tried with the strongest signal first. The scan blocks for about 1 to 2 seconds, in
+wifi_start() or wifi_poll(), once per start: at boot when the last network fails, and after a lost
+connection. Without the wifi_scan setting nothing in the state machine blocks.
+
+The other calls that block: mqtt_connect() and mqtt_poll() for the DNS lookup of the broker (see
+sensemqtt/robust.py, the connection itself does not wait for the broker), and ntp_sync_time() for
+up to a second per NTP request.
 """
 
+import json
 import senselogging as logging
 import time
-from binascii import hexlify
+from binascii import hexlify, unhexlify
+from time import ticks_diff, ticks_ms
 
 import machine
 import network
 import ntptime
 import settings
 
-from sensemqtt.robust import MQTTClient
+from sensemqtt.robust import BACKOFF, MQTTClient
 
 # MQTT related stuff
 _callbacks = {}  # topic -> callback mapping.
 _main_topic = b"#"  # Default to all topics (not recommended)
+_topic_prefixes = []  # The main and group topics, longest first
+# The topic trie compiled from _callbacks. A node is a list, indexed by:
+_KIDS = 0  # dict first byte of the level (-1 for an empty level) -> list of (level, node)
+_PLUS = 1  # The node for the "+" wildcard, or None
+_HASH = 2  # The callbacks for the "#" wildcard
+_HERE = 3  # The callbacks for topics that end at the node
+_trie = [{}, None, [], []]  # The callbacks in the lists are (pattern, callback) tuples
+_rx_topic = None  # The topic (memoryview) of the message being dispatched
+_rx_start = 0  # The offset of the sub-topic in _rx_topic
 _mqtt_client = None  # The MQTT client object
+_mqtt_state = None  # The last logged MQTT connection state
+
+
+def _wait(ms, idle):
+    """Wait ms milliseconds, running idle(ms) if given instead of sleeping."""
+    if idle is None:
+        time.sleep_ms(ms)
+    else:
+        idle(ms)
 
 
 def mqtt_register_callback(topic, callback):
     """
     Register a callback for a topic. If the callback is None, the topic is unregistered.
-    The callback will be called with two arguments: the topic (str) and the message (bytes like).
+    The topic is relative to the main topic or a group topic, and may contain the MQTT wildcards
+    "+" (one level) and "#" (the remaining levels, last only), e.g. "command/+" or "forest/#".
+    The callback will be called with two arguments: the topic it was registered for (str), and the
+    message (a memoryview into the receive buffer, only valid during the call). A callback for a
+    topic with wildcards gets the actual sub-topic from mqtt_sub_topic().
+    All callbacks with a matching topic are called.
 
     Args:
         topic (str): The topic for which the callback is to be registered.
@@ -49,66 +101,156 @@ def mqtt_register_callback(topic, callback):
     global _callbacks
     if callback is None:
         # We are dealing with a delete request
-        previous_cb = None
-        if topic in _callbacks:
-            previous_cb = _callbacks[topic]
-            del _callbacks[topic]
-        return previous_cb
-    # A new one, just register it
-    _callbacks[topic] = callback
-    return None
+        previous_cb = _callbacks.pop(topic, None)
+    else:
+        # A new one, just register it
+        previous_cb = _callbacks.get(topic)
+        _callbacks[topic] = callback
+    _trie_compile()
+    return previous_cb
+
+
+def mqtt_sub_topic():
+    """
+    Return the sub-topic (bytes, without the main or group topic) of the message being handled.
+    Only valid during a callback, e.g. for callbacks of topics with wildcards.
+    """
+    return bytes(_rx_topic[_rx_start:])
+
+
+def _trie_node():
+    """Return a new, empty topic trie node, see _trie."""
+    return [{}, None, [], []]
+
+
+def _trie_compile():
+    """Build the topic trie from the registered callbacks."""
+    global _trie
+
+    root = _trie_node()
+    for pattern, callback in _callbacks.items():
+        node = root
+        for level in pattern.encode().split(b"/"):
+            if level == b"#":
+                node[_HASH].append((pattern, callback))
+                break
+            if level == b"+":
+                if node[_PLUS] is None:
+                    node[_PLUS] = _trie_node()
+                node = node[_PLUS]
+                continue
+            kids = node[_KIDS].setdefault(level[0] if level else -1, [])
+            for kid_level, kid in kids:
+                if kid_level == level:
+                    node = kid
+                    break
+            else:
+                kid = _trie_node()
+                kids.append((level, kid))
+                node = kid
+        else:
+            node[_HERE].append((pattern, callback))
+    _trie = root
+
+
+def _mqtt_call(pattern, callback, msg):
+    """Call the callback registered for the pattern, logging any errors."""
+    try:
+        callback(pattern, msg)
+    except Exception as e:
+        logging.exc(e, "Error in handler for %s.", pattern)
+
+
+def _at(topic, pos, end, s):
+    """Return True if topic[pos:end] equals the bytes s, without making a slice."""
+    if end - pos != len(s):
+        return False
+    for k in range(len(s)):
+        if topic[pos + k] != s[k]:
+            return False
+    return True
+
+
+def _trie_route(node, topic, pos, msg):
+    """
+    Call the callbacks in the trie below node that match the levels of the topic from pos on.
+    The levels are found by their byte offsets in the topic, so nothing is copied or allocated.
+
+    Returns:
+        int: The number of callbacks called.
+    """
+    n = 0
+    for pattern, callback in node[_HASH]:  # Matches the remaining levels, also none
+        _mqtt_call(pattern, callback, msg)
+        n += 1
+    size = len(topic)
+    if pos > size:  # All levels matched
+        for pattern, callback in node[_HERE]:
+            _mqtt_call(pattern, callback, msg)
+            n += 1
+        return n
+    end = pos
+    while end < size and topic[end] != 0x2F:  # "/"
+        end += 1
+    for level, kid in node[_KIDS].get(topic[pos] if end > pos else -1, ()):
+        if _at(topic, pos, end, level):
+            n += _trie_route(kid, topic, end + 1, msg)
+            break
+    if node[_PLUS] is not None:
+        n += _trie_route(node[_PLUS], topic, end + 1, msg)
+    return n
 
 
 def _mqtt_incoming(topic, msg):
     """
-    Handles incoming MQTT messages by dispatching them to the appropriate handler.
-    This function processes the incoming MQTT message by stripping and decoding the topic,
-    checking if it starts with the main topic, and then dispatching it to the corresponding
-    handler if one exists. If no handler is found for the topic, it logs a message. Any
+    Handles incoming MQTT messages by dispatching them to the matching callbacks.
+    The main or group topic is skipped, and the rest is matched against the topic trie in place,
+    on the memoryview, without decoding or copying. If no callback matches, it logs a message. Any
     exceptions raised during the handling process are caught and logged.
     Args:
-        topic (bytes): The topic of the incoming MQTT message.
-        msg (bytes): The payload of the incoming MQTT message.
-    Raises:
-        Exception: If an unexpected error occurs during the processing of the message.
+        topic (memoryview): The topic of the incoming MQTT message.
+        msg (memoryview): The payload of the incoming MQTT message.
     """
+    global _rx_topic, _rx_start
     try:
-        topic = topic.strip().decode()  # Convert to string
-        if topic.startswith(_main_topic):
-            topic = topic[len(_main_topic) :]  # Strip the main topic prefix
-
-        handler = _callbacks.get(topic, None)  # Is there a handler for the topic?
-        if handler is not None:
-            # Call the handler and hope for the best ;-)
-            try:
-                handler(topic, msg)
-            except Exception as e:
-                logging.exc(e, "Error in handler for %s.", topic)
-        else:
-            logging.warning('No handler for MQTT sub-topic: "%s".', topic)
+        start = 0
+        for prefix in _topic_prefixes:
+            if len(topic) >= len(prefix) and _at(topic, 0, len(prefix), prefix):
+                start = len(prefix)  # Skip the main or group topic
+                break
+        _rx_topic, _rx_start = topic, start
+        if not _trie_route(_trie, topic, start, msg):
+            logging.warning('No handler for MQTT sub-topic: "%s".', bytes(topic[start:]))
     except Exception as e:
         logging.exc(e, "Unexpected error in incoming MQTT handling.")
+    _rx_topic = None  # The receive buffer is reused
 
 
 def _mqtt_has_connected():
-    """Set subscription on (re)connection."""
+    """Set subscriptions on (re)connection."""
     if _mqtt_client is not None:
-        _mqtt_client.subscribe(_main_topic + "#", qos=0)
+        for prefix in _topic_prefixes:
+            # A group topic below another prefix is covered by its subscription already.
+            if not any(prefix.startswith(p) for p in _topic_prefixes if p != prefix):
+                _mqtt_client.subscribe(prefix + b"#", qos=0)
+        logging.info("MQTT Connected and subscribed to %s", [p + b"#" for p in _topic_prefixes])
 
 
 def mqtt_connect(clean_session=True):
     """
     Connects to the MQTT broker using the provided settings.
-    This function retrieves MQTT settings, initializes the MQTT client, and attempts to connect to the MQTT broker.
-    If a connection attempt fails, it will retry indefinitely until a connection is established.
+    This function retrieves MQTT settings, initializes the MQTT client, and starts an attempt to
+    connect to the MQTT broker, which mqtt_poll() completes without waiting for the broker. If it
+    fails, mqtt_poll() retries with exponential backoff. Meanwhile mqtt_publish() queues the messages.
+    Only the DNS lookup of the broker blocks, see sensemqtt/robust.py.
     Args:
         clean_session (bool): If True, the broker will not send retained messages. Defaults to True.
     Returns:
-        MQTTClient: The connected MQTT client instance.
+        MQTTClient: The MQTT client instance, connected or not.
     Raises:
         Exception: If an error occurs during the connection process.
     """
-    global _main_topic, _mqtt_client
+    global _main_topic, _mqtt_client, _topic_prefixes
 
     if _mqtt_client is not None:
         # Disconnect the existing client if any
@@ -125,12 +267,14 @@ def mqtt_connect(clean_session=True):
         mqtt_client_id,
         mqtt_server,
         _main_topic,
+        group_topics,
     ) = settings.settings_get_many(
         "mqtt_user",
         "mqtt_pass",
         "mqtt_client_id",
         "mqtt_server",
         "main_topic",
+        "group_topics",
     )
     # Provide a default client_id if required
     mqtt_client_id = hexlify(
@@ -141,6 +285,14 @@ def mqtt_connect(clean_session=True):
     if not _main_topic.endswith("/"):
         _main_topic += "/"
     _main_topic = _main_topic.encode()
+    _topic_prefixes = [_main_topic]
+    for group_topic in (group_topics or "").split(","):
+        group_topic = group_topic.strip()
+        if group_topic:
+            group_topic = (group_topic if group_topic.endswith("/") else group_topic + "/").encode()
+            if group_topic not in _topic_prefixes:
+                _topic_prefixes.append(group_topic)
+    _topic_prefixes.sort(key=len, reverse=True)
 
     logging.info(
         "Connecting to MQTT server %s with main topic %s", mqtt_server, _main_topic
@@ -152,57 +304,63 @@ def mqtt_connect(clean_session=True):
     _mqtt_client.set_callback(_mqtt_incoming)
     _mqtt_client.set_on_connect(_mqtt_has_connected)
 
-    while True:
-        try:
-            _mqtt_client.connect(clean_session=clean_session)
-            break
-        except Exception as e:
-            logging.exc(
-                e, "Failed to connect to MQTT broker %s as %s.", mqtt_server, mqtt_user
-            )
-            time.sleep(1)
-
-    logging.info("MQTT Connected and subscribed to %s", _main_topic + "#")
+    if not _mqtt_client.connect(clean_session=clean_session) and _mqtt_client.state == BACKOFF:
+        logging.warning(
+            "Failed to connect to MQTT broker %s as %s, will retry.", mqtt_server, mqtt_user
+        )
+    _mqtt_log_state()
 
     return _mqtt_client
 
 
+def _mqtt_log_state():
+    """Log changes of the MQTT connection state."""
+    global _mqtt_state
+    state = _mqtt_client.state
+    if state != _mqtt_state:
+        _mqtt_state = state
+        stats = _mqtt_client.stats()
+        logging.info(
+            "MQTT %s after %d attempts, next attempt in %d ms.",
+            state,
+            stats["attempts"],
+            stats["backoff_ms"],
+        )
+
+
 def mqtt_poll():
     """
     Polls the MQTT client for incoming messages.
     This function polls the MQTT client for incoming messages and processes them using the
-    registered handlers. If no client is connected, it will attempt to reconnect to the MQTT
-    broker before polling for messages.
+    registered handlers. If the client is not connected, it makes a reconnect attempt instead
+    when one is due. It never waits for the broker.
     Returns:
         None
-    Raises:
-        Exception: If an error occurs during the polling process.
     """
-    global _mqtt_client
     if _mqtt_client is None:
         return
     try:
         _mqtt_client.check_msg()
     except Exception as e:
         logging.exc(e, "Error polling MQTT.")
-        _mqtt_client = None  # Abandon the client to force a reconnect
+    _mqtt_log_state()
 
 
-def mqtt_publish(sub_topic, msg, main_topic=None, retain=False):
+def mqtt_publish(sub_topic, msg, main_topic=None, retain=False, qos=0):
     """
     Publishes a message to the MQTT broker.
-    This function publishes a message to the MQTT broker using the provided topic and message.
+    This function queues a message for the MQTT broker using the provided topic and message.
+    The queue is sent by mqtt_poll(), and while the client is not connected, after reconnecting.
     Args:
         topic (str|bytes): The topic to which the message should be published.
-        msg (bytes): The message to be published.
+        msg (str|bytes): The message to be published.
         main_topic (str|bytes): The main topic to be used for the message.
             If None, the default main topic is used. If empty, no main topic is prepended and
             just the sub_topic is used.
         retain (bool): If True, the message will be retained by the broker. Defaults to False.
-    Returns:
-        MQTTMessageInfo: An instance of MQTTMessageInfo, which provides information about the message delivery.
+        qos (int): 0 or 1. QoS 1 messages are sent again until the broker acknowledges them.
     Raises:
-        Exception: If an error occurs during the publishing process.
+        RuntimeError: If there is no MQTT client, see mqtt_connect().
     """
     if _mqtt_client is None:
         raise RuntimeError("MQTT client not connected.")
@@ -214,19 +372,62 @@ def mqtt_publish(sub_topic, msg, main_topic=None, retain=False):
         sub_topic = sub_topic.encode()
     topic = topic.strip(b"/ ") + b"/" + sub_topic.strip(b"/ ")
 
+    if isinstance(msg, str):
+        msg = msg.encode()
+
     logging.debug("Publishing to %s: %s", topic, msg)
-    return _mqtt_client.publish(topic, msg, retain=retain)
+    _mqtt_client.publish(topic, msg, retain=retain, qos=qos)
 
 
 def mqtt_connected():
     return _mqtt_client is not None and _mqtt_client.isconnected()
 
 
+def mqtt_stats():
+    """
+    Return a dict with the MQTT connection state and counters.
+
+    Returns:
+        dict: The state ("none" without client, "connected", "connecting", "backoff" or
+              "disconnected"), the connect attempts, failures and successes, the connection drops,
+              the current backoff in ms, and the number of queued and dropped publishes.
+    """
+    if _mqtt_client is None:
+        return {"state": "none"}
+    return _mqtt_client.stats()
+
+
 ## WiFi orelated stuff
 #
 _wifi_ap = network.WLAN(network.AP_IF)
 _wifi_sta = network.WLAN(network.STA_IF)
 
+WIFI_IDLE = "idle"  # Not started, or stopped
+WIFI_CONNECTING = "connecting"  # Trying the stations in turn
+WIFI_STA = "sta"  # Connected to a station
+WIFI_AP = "ap"  # Running the fall-back access point
+WIFI_TIMEOUT_MS = 25000  # Time in ms to wait for a station to connect before trying the next
+WIFI_POLL_MS = 500  # wifi_connect() polls this often
+# Station status codes that mean the station will not connect, so no need to wait for the timeout.
+_WIFI_FAILED = tuple(
+    getattr(network, s)
+    for s in ("STAT_WRONG_PASSWORD", "STAT_NO_AP_FOUND", "STAT_CONNECT_FAIL")
+    if hasattr(network, s)
+)
+WIFI_CACHE_FILE = "wifi.json"  # The last good network, used with the wifi_scan setting
+_WIFI_SCAN = None  # Queue entry to scan and queue the configured networks in range
+
+_wifi_state = WIFI_IDLE  # The state of the WiFi state machine
+_wifi_queue = []  # The (ssid, passwd, bssid, channel) of the stations still to try, or _WIFI_SCAN
+_wifi_stations = {}  # The configured networks, ssid -> passwd
+_wifi_scan_mode = False  # True with the wifi_scan setting on
+_wifi_entry = None  # The queue entry being tried or connected to
+_wifi_ssid = None  # The station being tried or connected to
+_wifi_since = 0  # ticks_ms() of the last state change
+_wifi_started = 0  # ticks_ms() of the last wifi_start()
+_wifi_callback = None  # Called with the old and new state on state changes
+_wifi_stats = {"transitions": 0, "connects": 0, "failures": 0, "scans": 0, "connect_ms": None}
+
 
 def is_wifi_connected():
     """
@@ -248,58 +449,221 @@ def is_wifi_connected():
     return None  # We are not connected to anything
 
 
-def wifi_connect(reconnect=False):
+def _wifi_set_state(state):
+    """Change the WiFi state, update the metrics and call the state change callback."""
+    global _wifi_state, _wifi_since
+
+    old = _wifi_state
+    if state == old:
+        return
+    _wifi_state = state
+    _wifi_since = ticks_ms()
+    _wifi_stats["transitions"] += 1
+    logging.debug("WiFi state %s -> %s", old, state)
+    if _wifi_callback is not None:
+        try:
+            _wifi_callback(old, state)
+        except Exception as e:
+            logging.exc(e, "Error in WiFi state callback.")
+
+
+def wifi_set_callback(callback):
     """
-    Connects to a WiFi network or starts an access point if no network is available.
-    If the device is already connected to a WiFi network and `reconnect` is False,
-    the function will do nothing. Otherwise, it will attempt to connect to the WiFi
-    networks listed in the settings. If no connection is successful, it will start
-    an access point.
+    Set the function called on WiFi state changes, or None for none.
+    The callback is called with the old and the new state.
+    """
+    global _wifi_callback
+    _wifi_callback = callback
+
+
+def wifi_state():
+    """Return the WiFi state: WIFI_IDLE, WIFI_CONNECTING, WIFI_STA or WIFI_AP."""
+    return _wifi_state
+
+
+def wifi_stats():
+    """
+    Return a dict with the WiFi state and connection metrics.
+
+    Returns:
+        dict: The state, the ssid tried or connected to, the ms in the current state, the number
+              of state transitions, successful connects and failed station attempts, and the ms
+              the last successful connect took from wifi_start().
+    """
+    stats = dict(_wifi_stats)
+    stats["state"] = _wifi_state
+    stats["ssid"] = _wifi_ssid
+    stats["state_ms"] = ticks_diff(ticks_ms(), _wifi_since)
+    return stats
+
+
+def wifi_start(reconnect=False):
+    """
+    Start connecting to WiFi without waiting. The connection is advanced by wifi_poll().
+    If the device is already connected and reconnect is False, the state is just updated.
+    With the wifi_scan setting on, the last good network is tried first and then the networks
+    in range, strongest first.
+
     Args:
         reconnect (bool): If True, forces reconnection to the WiFi network even if
                           already connected. Defaults to False.
     Raises:
         Exception: If there is an error parsing the wifi_stations setting.
     Returns:
-        Same as is_connected().
+        str: The WiFi state.
     """
-    if not reconnect and is_wifi_connected():
-        logging.info("Already connected to WiFi; nothing done.")
-        return is_wifi_connected()
+    global _wifi_queue, _wifi_stations, _wifi_scan_mode, _wifi_started
+
+    if not reconnect:
+        connected = is_wifi_connected()
+        if connected:
+            logging.info("Already connected to WiFi; nothing done.")
+            _wifi_set_state(WIFI_STA if connected == "STA" else WIFI_AP)
+            return _wifi_state
 
     # Dispose of earlier connections if any.
     _wifi_ap.active(False)
     _wifi_sta.active(False)
 
     try:
-        station_list = eval(settings.settings_get("wifi_stations", "[]"))
+        station_list = _wifi_parse_stations(settings.settings_get("wifi_stations", "[]"))
     except Exception as e:
         logging.exc(e, "Error parsing wifi_stations setting.")
         raise
 
-    # Attempt all stations in the list
-    for ssid, passwd in station_list:
-        logging.info('Attempting WiFi network "%s".', ssid)
-        _wifi_sta.active(True)
-        _wifi_sta.connect(ssid, passwd)
-        print(f"{ssid}: .", end="")
-        for _ in range(50):
-            if not _wifi_sta.isconnected():
-                time.sleep(0.5)
-                print(".", end="")
-            else:
-                print()
-                logging.info(
-                    'Connected to Wifi network "%s" with IP %s.',
-                    ssid,
-                    _wifi_sta.ifconfig()[0],
-                )
-                return is_wifi_connected()
-        print()
-        logging.info('Connecting WiFi network "%s" failed!', ssid)
-        _wifi_sta.active(False)
-
-    # No WiFi network found, start an access point as fall-back
+    _wifi_stations = dict(station_list)
+    _wifi_scan_mode = settings.settings_get("wifi_scan", "0").strip() == "1"
+    if _wifi_scan_mode:
+        _wifi_queue = []
+        last = _wifi_load_last()
+        if last is not None and last[0] in _wifi_stations:
+            ssid, bssid, channel = last
+            _wifi_queue.append((ssid, _wifi_stations[ssid], bssid, channel))
+        _wifi_queue.append(_WIFI_SCAN)
+    else:
+        _wifi_queue = [(ssid, passwd, None, None) for ssid, passwd in station_list]
+    _wifi_started = ticks_ms()
+    _wifi_next_station()
+    return _wifi_state
+
+
+def _wifi_parse_stations(text):
+    """
+    Parse the wifi_stations setting, a list of (ssid, passwd) tuples of quoted strings, without
+    eval(). Only the strings are taken; brackets, commas and whitespace between them are skipped.
+    Backslash escapes a quote or backslash in a string.
+
+    Returns:
+        list: The (ssid, passwd) tuples.
+
+    Raises:
+        ValueError: If the setting has anything else, or an odd number of strings.
+    """
+    strings = []
+    i, n = 0, len(text)
+    while i < n:
+        c = text[i]
+        i += 1
+        if c in "\"'":
+            chars = []
+            while i < n and text[i] != c:
+                if text[i] == "\\":
+                    i += 1
+                chars.append(text[i : i + 1])
+                i += 1
+            if i >= n:
+                raise ValueError("unterminated string")
+            strings.append("".join(chars))
+            i += 1
+        elif c not in "[](), \t":
+            raise ValueError("unexpected " + c)
+    if len(strings) % 2:
+        raise ValueError("ssid without password")
+    return [(strings[k], strings[k + 1]) for k in range(0, len(strings), 2)]
+
+
+def _wifi_next_station():
+    """Start connecting to the next station, or start the access point if none are left."""
+    global _wifi_entry, _wifi_ssid, _wifi_since
+
+    if _wifi_queue and _wifi_queue[0] is _WIFI_SCAN:
+        _wifi_queue[:1] = _wifi_scan()
+    if not _wifi_queue:
+        _wifi_entry = _wifi_ssid = None
+        _wifi_start_ap()
+        return
+    _wifi_entry = _wifi_queue.pop(0)
+    _wifi_ssid, passwd, bssid, _ = _wifi_entry
+    _wifi_sta.active(True)
+    if bssid is None:
+        logging.info('Attempting WiFi network "%s".', _wifi_ssid)
+        _wifi_sta.connect(_wifi_ssid, passwd)
+    else:
+        logging.info('Attempting WiFi network "%s" on %s.', _wifi_ssid, hexlify(bssid).decode())
+        _wifi_sta.connect(_wifi_ssid, passwd, bssid=bssid)
+    _wifi_set_state(WIFI_CONNECTING)
+    _wifi_since = ticks_ms()  # The timeout starts for each station
+
+
+def _wifi_scan():
+    """
+    Scan for networks and return the queue entries of the configured networks in range, with the
+    strongest signal first. The access point (BSSID) with the strongest signal is used for each
+    network. The network of a failed entry tried before the scan is tried again only on another
+    access point.
+    """
+    _wifi_stats["scans"] += 1
+    _wifi_sta.active(True)
+    try:
+        found = _wifi_sta.scan()
+    except Exception as e:
+        logging.exc(e, "WiFi scan failed.")
+        found = ()
+    tried = None if _wifi_entry is None else _wifi_entry[2]
+    best = {}  # ssid -> (rssi, bssid, channel)
+    for ap in found:
+        ssid, bssid, channel, rssi = ap[:4]
+        ssid = ssid.decode()
+        if ssid in _wifi_stations and bssid != tried and rssi > best.get(ssid, (-999,))[0]:
+            best[ssid] = (rssi, bssid, channel)
+    entries = sorted(best.items(), key=lambda x: -x[1][0])
+    logging.info(
+        "WiFi scan found %d configured networks: %s", len(entries), [e[0] for e in entries]
+    )
+    return [(ssid, _wifi_stations[ssid], bssid, channel) for ssid, (_, bssid, channel) in entries]
+
+
+def _wifi_load_last():
+    """Return the (ssid, bssid, channel) of the last good network from flash, or None."""
+    try:
+        with open(WIFI_CACHE_FILE) as f:
+            last = json.load(f)
+        bssid = last.get("bssid")
+        return last["ssid"], None if bssid is None else unhexlify(bssid), last.get("channel")
+    except Exception:
+        return None
+
+
+def _wifi_save_last(ssid, bssid, channel):
+    """Save the last good network to flash, if it changed."""
+    if _wifi_load_last() == (ssid, bssid, channel):
+        return
+    try:
+        with open(WIFI_CACHE_FILE, "w") as f:
+            json.dump(
+                {
+                    "ssid": ssid,
+                    "bssid": None if bssid is None else hexlify(bssid).decode(),
+                    "channel": channel,
+                },
+                f,
+            )
+    except Exception as e:
+        logging.exc(e, "Could not save the last good WiFi network.")
+
+
+def _wifi_start_ap():
+    """Start the fall-back access point."""
     ap = settings.settings_get("wifi_ap_pfx", "sense") + "-" + hexlify(machine.unique_id()).decode()
     logging.info('No WiFi network found. Starting AP with SSID "%s".', ap)
     _wifi_ap.active(True)
@@ -309,36 +673,97 @@ def wifi_connect(reconnect=False):
         password=settings.settings_get("wifi_ap_passwd", "xmas-tree"),
     )
     logging.info("AP %s started with IP %s", ap, _wifi_ap.ifconfig()[0])
+    _wifi_set_state(WIFI_AP)
+
+
+def wifi_poll():
+    """
+    Advance the WiFi connection without waiting. Call this regularly, e.g. from the main loop.
+    While connecting it checks the station being tried, and moves on to the next station when it
+    failed or timed out. When connected, it starts over if the connection was lost. With the
+    wifi_scan setting on, moving on to the networks in range blocks for the scan, see the module
+    description.
 
+    Returns:
+        str: The WiFi state.
+    """
+    if _wifi_state == WIFI_CONNECTING:
+        if _wifi_sta.isconnected() and _wifi_sta.ifconfig()[0] != "0.0.0.0":
+            _wifi_stats["connects"] += 1
+            _wifi_stats["connect_ms"] = ticks_diff(ticks_ms(), _wifi_started)
+            logging.info(
+                'Connected to Wifi network "%s" with IP %s.', _wifi_ssid, _wifi_sta.ifconfig()[0]
+            )
+            if _wifi_scan_mode:
+                _wifi_save_last(_wifi_ssid, _wifi_entry[2], _wifi_entry[3])
+            _wifi_set_state(WIFI_STA)
+        elif (
+            _wifi_sta.status() in _WIFI_FAILED
+            or ticks_diff(ticks_ms(), _wifi_since) > WIFI_TIMEOUT_MS
+        ):
+            _wifi_stats["failures"] += 1
+            logging.info('Connecting WiFi network "%s" failed!', _wifi_ssid)
+            _wifi_sta.active(False)
+            _wifi_next_station()
+    elif _wifi_state == WIFI_STA and is_wifi_connected() != "STA":
+        logging.warning('WiFi connection to "%s" lost, reconnecting.', _wifi_ssid)
+        wifi_start(reconnect=True)
+    return _wifi_state
+
+
+def wifi_connect(reconnect=False, idle=None):
+    """
+    Connects to a WiFi network or starts an access point if no network is available, and waits
+    until that is done. If the device is already connected to a WiFi network and `reconnect` is
+    False, the function will do nothing. Otherwise, it will attempt to connect to the WiFi
+    networks listed in the settings. If no connection is successful, it will start
+    an access point. Use wifi_start() and wifi_poll() to connect without waiting.
+    Args:
+        reconnect (bool): If True, forces reconnection to the WiFi network even if
+                          already connected. Defaults to False.
+        idle (function, optional): Called with the time in ms to wait while connecting instead of
+                                   sleeping.
+    Raises:
+        Exception: If there is an error parsing the wifi_stations setting.
+    Returns:
+        Same as is_connected().
+    """
+    wifi_start(reconnect)
+    while wifi_poll() == WIFI_CONNECTING:
+        _wait(WIFI_POLL_MS, idle)
     return is_wifi_connected()
 
 
 ## NTP Time
 #
-def ntp_sync_time():
+def ntp_sync_time(idle=None, tries=3):
     """
     Synchronizes the system time with an NTP server.
     This function checks if the device is connected to WiFi. If it is connected,
     it retrieves the current time from an NTP server and adjusts it according to
     the time offset specified in the settings. The adjusted time is then set to
     the device's real-time clock (RTC).
+    Args:
+        idle (function, optional): Called with the time in ms to wait between retries instead of sleeping.
+        tries (int, optional): Number of NTP requests before giving up. Defaults to 3.
     Returns:
-        None
+        bool: True if the time was synchronized.
     """
     if not _wifi_sta.isconnected():
         logging.info("Not connected to WiFi, cannot set time.")
-        return
+        return False
 
     old_time = time.gmtime()
-    for _ in range(3):
+    for i in range(tries):
         try:
             t = ntptime.time()  # seconds since epoch in UTC
             break
         except Exception:
-            time.sleep(1)  # ntp too busy, wait a bit
+            if i < tries - 1:
+                _wait(1000, idle)  # ntp too busy, wait a bit
     else:
         logging.info("Failed to synchronize time with NTP.")
-        return
+        return False
     offset = int(settings.settings_get("time_offset", 0)) * 60
     tm = time.gmtime(t + offset)
     machine.RTC().datetime((tm[0], tm[1], tm[2], tm[6] + 1, tm[3], tm[4], tm[5], 0))
@@ -349,3 +774,4 @@ def ntp_sync_time():
         "{0:02}/{1:02}/{2:02} {3:02}:{4:02}:{5:02}".format(*new_time),
         offset // 60,
     )
+    return True
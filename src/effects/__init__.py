@@ -2,74 +2,283 @@
 Description: This module provides functions and a class to initialize and run effects on the matrix.
 It includes a base class for all effects, utility functions and constants, and an asynchronous mode.
 
+Effects can be switched with a transition. During a transition the old and the new effect both keep
+running, each drawing into its own off-screen frame, and the frames are blended onto the matrix.
+Choose the transition in the effect JSON, e.g. {"effect": "cycle", "transition": "fade", "ms": 800}.
+Transitions are "none" (default), "fade" and "wipe".
+
+A command for the effect that is running already updates its parameters in place, keeping its
+animation state, e.g. {"effect": "cycle", "wait": 50}. Add "update": false to restart it instead.
+A command with a parameter the effect cannot change in place (see EffectBase.update_params)
+restarts it too. {"update": true, "color": "(0,0,200)"} updates the running effect, whatever it is.
+
+The effect registry is lazy by default: the name, purpose and help JSON of all effects are kept in
+a manifest file in this package, which is rebuilt when the effect sources change. At boot only the
+manifest is read; an effect module is imported when the effect is started for the first time.
+
+Effect frames are scheduled on fixed deadlines, every "wait" ms. When a frame is late by a whole frame
+or more, this is counted as an overrun. The "drop" policy (default) then skips the missed frames, the
+"catchup" policy renders them back to back (up to MAX_CATCHUP frames).
+
+Effect commands from MQTT are coalesced: the handler only keeps the latest command, and
+effect_loop() applies it at the next frame, at most one command every COMMAND_MS. A burst of
+commands thus starts only the last effect of each poll cycle or window, and the effect stats count
+the commands received and applied.
+
+High-rate controllers can send effect commands in a compact binary format on the /effect/bin sub
+topic instead of JSON. A command is a header of BIN_HEADER: the version (BIN_VERSION), the effect
+ID (from BIN_EFFECT_IDS, or BIN_RUNNING to update the running effect) and flags
+(BIN_RESTART to restart a running effect instead of updating it). It is followed by parameters as
+tag, length and value, with the tags in BIN_PARAMS. Numbers are unsigned big-endian of 1 to 4
+bytes, colors are 3 bytes (r, g, b) and strings UTF-8. Unknown tags are skipped. pack_command() builds a command.
+
 Author: Karijn Wessing and Gijs Mos, Sensemakers Amsterdam
 Maintainer: Sensemakers Amsterdam  https://sensemakersams.org
 
 Functions:
-- init_effects(matrix, use_async=False): Initialize the effects module with the given matrix object.
+- init_effects(matrix, frame_policy="drop", lazy=True): Initialize the effects module with the given matrix object.
 - get_effects(): Return a tuple of all registered effect objects, sorted by effect name.
 - get_effect_name(effect): Return the name of the effect passed in.
 - all_effect_names(): Return a tuple of the names of all registered effects sorted.
 - get_effect_purpose(effect): Return the purpose of the effect as a string.
 - get_effect_json(effect): Return the JSON string to use to start the effect.
-- effect_by_name(effect_name): Return the effect object by name or None if not found.
+- effect_by_name(effect_name): Return the effect object by name or alias, or None if not found.
 - effect_loop(): Execute the loop method of the current effect if it exists.
+- effect_loop_async(): Run the effect loop forever as an asyncio task.
+- effect_time_to_next(): Return the time in ms until the next frame is due.
+- effect_stats(): Return a dict with the frame, overrun and effect command counts.
 - start_effect(effect, params=None): Start an effect with optional effect-specific parameters.
 - start_effect_by_name(effect_name, params=None): Start an effect by name with optional effect-specific parameters.
 - start_effect_from_json(json_str): Start an effect from a JSON string.
-- mqtt_effect_handler(topic, msg): Handler for the /effect MQTT sub topic.
+- start_effect_from_bin(data): Start an effect from a binary command.
+- bin2params(data): Return the effect ID and the params dict of a binary command.
+- pack_command(effect_name, params=None): Return the binary command for an effect and its params.
+- update_effect(params): Update the parameters of the running effect in place.
+- mqtt_effect_handler(topic, msg): Handler for the /effect and /effect/bin MQTT sub topics, keeps the command for effect_loop().
+- pack_palette(colors): Return a palette packed into a bytearray from a sequence of (r, g, b) colors.
+- palette_color(palette, index): Return the color at index in a packed palette as a tuple.
+- get_palette(name): Return the named packed palette or None if not found.
 - wheel(pos): Input a value 0 to 255 to get a color value.
 - random_color(color_list=RAINBOW): Return a random color from the list passed in.
 - full_help(): Return a string with the help for all effects.
 """
 
 import json
-from os import listdir
+import struct
+import sys
+from os import listdir, stat
+
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+
 from random import choice
-from time import ticks_ms
+from time import ticks_add, ticks_diff, ticks_ms
 import senselogging as logging
+from colors import parse_color
+from pixellib import crossfade
 
-_ASYNC = False  # Use asyncio for effect loop if True
 _matrix = None  # holds the matrix object to render the effects on
 _effects = ()  # holds the list of defined effects
+_effect_names = ()  # holds the names of the defined effects, in the order of _effects
+_by_name = {}  # maps effect names and aliases to the defined effects
+_help_text = None  # holds the full help text, built on first use
 _current_effect = None  # holds the running effect object
-
-
-def init_effects(matrix, use_async=False):
+_transition = None  # holds the running _Transition, if any
+_transition_frames = None  # holds the three off-screen frames used by transitions
+
+TRANSITIONS = ("none", "fade", "wipe")
+TRANSITION_FRAME_MS = 20  # Blend a transition frame at most every 20 ms (50 fps)
+_COMMAND_PARAMS = ("effect", "update", "transition", "ms")  # Not parameters of the effect
+
+FRAME_POLICIES = ("drop", "catchup")
+MAX_CATCHUP = 3  # The catchup policy drops frames when more than this many frames behind
+IDLE_MS = 100  # Time to next frame reported when there is no effect running
+_frame_policy = "drop"  # What to do with late frames, one of FRAME_POLICIES
+_stats = {"frames": 0, "overruns": 0, "commands": 0, "applied": 0}  # Statistics of all effects
+
+COMMAND_MS = 100  # Apply at most one effect command every 100 ms
+_pending = None  # The latest effect command received and not applied yet (bytes)
+_last_apply = 0  # ticks_ms() when the last effect command was applied
+_holding = False  # True while less than COMMAND_MS has passed since _last_apply
+_pending_bin = False  # True if the pending command is a binary one
+
+BIN_VERSION = 1  # Version of the binary command format
+BIN_HEADER = "!BBB"  # Binary command header: version, effect ID and flags
+BIN_RUNNING = 255  # Effect ID to update the running effect
+# Effect name -> fixed effect ID in binary commands. Give a new effect the next free ID, and never
+# change or reuse an ID, so the controllers keep starting the right effects.
+BIN_EFFECT_IDS = {
+    "blink": 0,
+    "cross": 1,
+    "cycle": 2,
+    "fire": 3,
+    "rainbow": 4,
+    "rowcol": 5,
+    "sensor": 6,
+    "wheelloop": 7,
+    "xmastree": 8,
+}
+_bin_effect_names = {i: name for name, i in BIN_EFFECT_IDS.items()}  # Effect ID -> effect name
+BIN_RESTART = 1  # Flag to restart a running effect instead of updating it, like "update": false
+# Binary command parameter tag -> (name, kind); kind "u" unsigned int, "c" color, "s" string.
+BIN_PARAMS = {
+    1: ("wait", "u"),
+    2: ("color", "c"),
+    3: ("transition", "s"),
+    4: ("ms", "u"),
+    5: ("style", "s"),
+}
+
+MANIFEST_FILE = "manifest.json"  # The effect registry manifest in the effects package directory
+
+
+def init_effects(matrix, frame_policy="drop", lazy=True):
     """
-    Initialize the effects module with the given matrix object and an optional asynchronous flag.
-    This function dynamically imports all Python modules in the current package directory
-    (excluding __init__.py) and collects their 'register' attributes if they exist. The collected
-    effects are then sorted by their name and stored in a global variable.
+    Initialize the effects module with the given matrix object, frame policy and registry mode.
+    This function collects the effects registered in the 'register' attribute of all Python modules
+    in the current package directory (excluding __init__), as .py or precompiled .mpy files. The
+    collected effects are then sorted by their name and stored in a global variable.
+    With lazy set, the effects are taken from the manifest if it matches the effect sources. The
+    effect modules are then imported on first use. Otherwise all modules are imported and the
+    manifest is rebuilt.
     Args:
         matrix (object): The matrix object to be used by the effects.
-        use_async (bool, optional): If True, enables asynchronous mode. Defaults to False.
+        frame_policy (str, optional): "drop" or "catchup" for late frames. Defaults to "drop".
+        lazy (bool, optional): Use the manifest and import effect modules on first use. Defaults to True.
     Raises:
         ImportError: If any of the dynamically imported modules do not have a 'register' attribute.
     Side Effects:
         Sets the global variables _matrix and _effects with the provided matrix and the collected effects.
-        If use_async is True, sets the global variable _ASYNC to True.
     """
-    global _matrix, _effects
+    global _matrix, _frame_policy
 
     _matrix = matrix
-    e = []
+    if frame_policy not in FRAME_POLICIES:
+        logging.error("Invalid frame policy %s, using drop.", frame_policy)
+        frame_policy = "drop"
+    _frame_policy = frame_policy
+
     pack_dir = __file__.rsplit("/", 1)[0]
-    for f in listdir(pack_dir):
-        if f.endswith(".py") and f != "__init__.py":
-            name = "effects." + f[:-3]
-            logging.debug("Importing %s", name)
-            exec(f"import {name}")
-            m = eval(name)
+    # The package is imported from the .py sources or from the precompiled .mpy bundle.
+    modules = sorted(f for f in listdir(pack_dir) if _is_module(f) and not f.startswith("__init__."))
+    signature = _source_signature(pack_dir, modules)
+    manifest_path = pack_dir + "/" + MANIFEST_FILE
+    e = _read_manifest(manifest_path, signature) if lazy else None
+    if e is None:
+        entries = []
+        for f in modules:
+            name = "effects." + f.rsplit(".", 1)[0]
+            m = _import(name)
             if hasattr(m, "register"):
-                e += m.register
+                entries += [(name, c) for c in m.register]
             else:
                 raise ImportError(f"Module {m} does not have a register attribute")
-    _effects = tuple(sorted(e, key=lambda x: x.__name__.lower()))
+        if lazy:
+            _write_manifest(manifest_path, signature, entries)
+    else:
+        entries = [(le._module, le) for le in e]
+    _build_index(entries)
+
+
+def _build_index(entries):
+    """
+    Set _effects, _effect_names and the _by_name lookup from (module name, effect) pairs.
+    Each effect is found by its name, and by the name of its module when that is not an effect name.
+    """
+    global _effects, _effect_names, _by_name, _help_text
+
+    entries = sorted(entries, key=lambda x: x[1].__name__.lower())
+    _effects = tuple(e for _, e in entries)
+    _effect_names = tuple(get_effect_name(e) for e in _effects)
+    _by_name = dict(zip(_effect_names, _effects))
+    for module, e in entries:
+        alias = module.rsplit(".", 1)[-1].lower()
+        if alias not in _by_name:
+            _by_name[alias] = e
+    _help_text = None
+
+
+def _is_module(f):
+    """Return True for the file name of a Python source or a precompiled module."""
+    return f.endswith(".py") or f.endswith(".mpy")
+
+
+def _import(name):
+    """Import the module name and return it."""
+    logging.debug("Importing %s", name)
+    __import__(name)
+    return sys.modules[name]
+
+
+def _source_signature(pack_dir, modules):
+    """Return a string that changes when any of the effect modules is changed, added or removed."""
+    parts = []
+    for f in modules:
+        st = stat(pack_dir + "/" + f)
+        parts.append(f"{f}:{st[6]}:{st[8]}")
+    return ";".join(parts)
+
+
+def _read_manifest(path, signature):
+    """Return the effects in the manifest as _LazyEffect objects, or None if missing or outdated."""
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except Exception:
+        logging.info("No effects manifest found.")
+        return None
+    if manifest.get("signature") != signature:
+        logging.info("Effects manifest is outdated.")
+        return None
+    return [_LazyEffect(*entry) for entry in manifest["effects"]]
+
+
+def _write_manifest(path, signature, effects):
+    """Write the manifest for the (module name, effect class) pairs passed in."""
+    entries = [(m, e.__name__, get_effect_purpose(e), get_effect_json(e)) for m, e in effects]
+    try:
+        with open(path, "w") as f:
+            json.dump({"signature": signature, "effects": entries}, f)
+        logging.info("Effects manifest written to %s.", path)
+    except Exception as e:
+        logging.exc(e, "Could not write effects manifest %s.", path)
+
+
+class _LazyEffect:
+    """
+    Registry entry for an effect whose module is only imported when the effect is first started.
+    It has the __name__, help_purpose and help_json of the effect class, and it is called like the
+    effect class to create an effect object.
+
+    Attributes:
+        _module (str): The name of the module of the effect.
+        _cls: The effect class once it is loaded, None before.
+    """
+
+    def __init__(self, module, name, purpose, help_json):
+        self.__name__ = name
+        self.help_purpose = purpose
+        self.help_json = help_json
+        self._module = module
+        self._cls = None
+
+    def load(self):
+        """Import the effect module if needed and return the effect class."""
+        if self._cls is None:
+            self._cls = getattr(_import(self._module), self.__name__)
+        return self._cls
 
-    if use_async:
-        global _ASYNC
-        _ASYNC = True
+    def __call__(self, matrix, params):
+        return self.load()(matrix, params)
+
+
+def _is_effect(effect):
+    """Return True for effect classes and lazy registry entries."""
+    return isinstance(effect, _LazyEffect) or (
+        isinstance(effect, type) and issubclass(effect, EffectBase)
+    )
 
 
 def get_effects():
@@ -87,12 +296,12 @@ def get_effect_name(effect):
     Return the name of the effect passed in.
 
     Args:
-        effect: The effect class to get the name of.
+        effect: The effect class or registry entry to get the name of.
 
     Returns:
         str: The name of the effect in lowercase.
     """
-    if not issubclass(effect, EffectBase):
+    if not _is_effect(effect):
         raise TypeError(f"Not an effect {effect}")
     return effect.__name__.lower()
 
@@ -104,7 +313,7 @@ def all_effect_names():
     Returns:
         tuple: A tuple containing the names of all registered effects in lowercase.
     """
-    return tuple(get_effect_name(e) for e in _effects)
+    return _effect_names
 
 
 def get_effect_purpose(effect):
@@ -112,13 +321,13 @@ def get_effect_purpose(effect):
     Return the purpose of the effect as a string.
 
     Args:
-        effect: The effect class to get the purpose of.
+        effect: The effect class or registry entry to get the purpose of.
 
     Returns:
         str: The purpose of the effect. If the effect has a 'help_purpose' attribute, it returns that.
              Otherwise, it returns a default message indicating the effect's name.
     """
-    assert issubclass(effect, EffectBase), f"Not an effect {effect}"
+    assert _is_effect(effect), f"Not an effect {effect}"
     if hasattr(effect, "help_purpose"):
         return effect.help_purpose
     else:
@@ -130,13 +339,13 @@ def get_effect_json(effect):
     Return the JSON string to use to start the effect.
 
     Args:
-        effect: The effect class to get the JSON string for.
+        effect: The effect class or registry entry to get the JSON string for.
 
     Returns:
         str: The JSON string representation of the effect. If the effect has a 'help_json' attribute,
              it returns that. Otherwise, it returns a default JSON string with the effect's name.
     """
-    assert issubclass(effect, EffectBase), f"Not an effect {effect}"
+    assert _is_effect(effect), f"Not an effect {effect}"
     if hasattr(effect, "help_json"):
         return effect.help_json
     else:
@@ -146,6 +355,7 @@ def get_effect_json(effect):
 def effect_by_name(effect_name):
     """
     Return the effect object by name or None if not found.
+    The name is case insensitive, and the name of the module of an effect may be used as well.
 
     Args:
         effect_name (str): The name of the effect to retrieve.
@@ -154,11 +364,10 @@ def effect_by_name(effect_name):
         EffectBase: The effect class if found, otherwise None.
     """
     assert isinstance(effect_name, str), "str with effect name expected"
-    effect_name = effect_name.lower()
-    for e in _effects:
-        if get_effect_name(e) == effect_name:
-            return e
-    return None
+    e = _by_name.get(effect_name)
+    if e is None:
+        e = _by_name.get(effect_name.lower())
+    return e
 
 
 def effect_loop():
@@ -166,25 +375,66 @@ def effect_loop():
     Execute the loop method of the current effect if it exists.
 
     This function checks if there is a current effect set, and if so, calls its loop method.
+    While a transition is running, both effects are run and their frames are blended.
+    A pending effect command is applied first when it is due.
     """
-    if _current_effect:
+    global _transition, _holding
+    # Checked on every call, so the ticks difference never gets large enough to wrap around.
+    if _holding and ticks_diff(ticks_ms(), _last_apply) >= COMMAND_MS:
+        _holding = False
+    if _pending is not None and not _holding:
+        _apply_command()
+    if _transition is not None:
+        if _transition.loop(_current_effect):
+            _transition = None
+    elif _current_effect:
         _current_effect.loop()
 
 
-if _ASYNC:
-    # Setup the asyncio version and create the effect task
-    import uasyncio as asyncio
+def effect_time_to_next():
+    """
+    Return the time in ms until the next frame is due.
 
-    async def effect_loop_async():
-        """
-        Asynchronous loop to execute the effect loop method.
+    Returns:
+        int: The time in ms until the next call of effect_loop() has work to do, 0 if overdue.
+    """
+    if _transition is not None:
+        ms = _transition.time_to_next(_current_effect)
+    elif _current_effect:
+        ms = _current_effect.time_to_next()
+    else:
+        ms = IDLE_MS
+    if _pending is not None:
+        ms = min(ms, COMMAND_MS - ticks_diff(ticks_ms(), _last_apply) if _holding else 0)
+    return max(0, ms)
 
-        This function calls the effect_loop function and then sleeps for 0 seconds to yield control.
-        """
-        effect_loop()
-        await asyncio.sleep(0)
 
-    asyncio.create_task(effect_loop_async())
+def effect_stats():
+    """
+    Return a dict with the frame, overrun and effect command counts.
+
+    Returns:
+        dict: "frames" rendered, "overruns" of frames late by a frame period or more, effect
+              "commands" received from MQTT and "applied", the others were replaced by later ones,
+              and the frames the matrix sent to the NeoPixels ("frames_written") and skipped as
+              unchanged ("frames_skipped").
+    """
+    stats = dict(_stats)
+    if _matrix is not None:
+        stats["frames_written"] = _matrix.frames_written
+        stats["frames_skipped"] = _matrix.frames_skipped
+    return stats
+
+
+async def effect_loop_async():
+    """
+    Run the effect loop forever as an asyncio task.
+
+    Between frames the task sleeps until the next frame is due, so other tasks get to run.
+    """
+    while True:
+        effect_loop()
+        await asyncio.sleep(effect_time_to_next() / 1000)
 
 
 def start_effect(effect, params=None):
@@ -194,16 +444,64 @@ def start_effect(effect, params=None):
     Args:
         effect (EffectBase): The class of the effect to start.
         params (dict, optional): A dictionary of parameters specific to the effect. Defaults to None.
-                                 Unrecognised parameters are ignored.
+                                 Unrecognised parameters are ignored. The "transition" and "ms"
+                                 parameters select the transition from the running effect.
+                                 If the effect is running already, its parameters are updated
+                                 instead, unless "update" is false.
 
     Returns:
-        The result of the efect's start() method, or None if not found.
+        The result of the efect's start() or update() method, or None if not found.
+
+    Raises:
+        ValueError: If the "wait" parameter is not positive. The running effect is kept.
     """
-    global _current_effect
+    global _current_effect, _transition, _transition_frames
     if params is None:
         params = {}
-    _current_effect = effect(_matrix, params)
-    return _current_effect.start()
+    if "wait" in params:
+        # Before anything changes. Stored as an int, as the effects take it from params as is.
+        params["wait"] = _check_wait(params["wait"])
+    # By name, as effect may be a lazy registry entry
+    if (
+        type(_current_effect).__name__ == effect.__name__
+        and params.get("update", True)
+        and _can_update(params)
+    ):
+        return update_effect(params)
+    kind = params.get("transition", "none")
+    ms = int(params.get("ms", 800))
+    if kind not in TRANSITIONS:
+        logging.warning("Unknown transition %s, using none.", kind)
+        kind = "none"
+    if kind == "none" or ms <= 0 or _current_effect is None:
+        _transition = None
+        _matrix.render_to(None)
+        _current_effect = effect(_matrix, params)
+        return _current_effect.start()
+
+    # Set up the off-screen frames: the old effect continues from its last frame, the new one
+    # starts from what is on the matrix now. The new effect always gets a frame that a running
+    # transition does not use, so when its constructor raises, that transition continues unchanged.
+    if _transition_frames is None:
+        _transition_frames = (_matrix.new_frame(), _matrix.new_frame(), _matrix.new_frame())
+    if _transition is not None:
+        # Switching during a transition: the new effect of that transition becomes the old one.
+        old_frame = _transition._new_frame
+        for new_frame in _transition_frames:
+            if new_frame is not old_frame and new_frame is not _transition._old_frame:
+                break
+    else:
+        old_frame, new_frame = _transition_frames[0], _transition_frames[1]
+        old_frame[:] = _matrix.buf
+    new_frame[:] = _matrix.buf
+    _matrix.render_to(new_frame)
+    try:
+        new = effect(_matrix, params)
+        _transition = _Transition(_current_effect, old_frame, new_frame, kind, ms)
+        _current_effect = new
+        return new.start()
+    finally:
+        _matrix.render_to(None)
 
 
 def start_effect_by_name(effect_name, params=None):
@@ -241,6 +539,8 @@ def start_effect_from_json(json_str):
         effect_name = effect_params.get("effect")
         if effect_name is not None:
             return start_effect_by_name(effect_name, effect_params)
+        if effect_params.get("update"):
+            return update_effect(effect_params)
         logging.warning('No "effect" in JSON: %s', json_str)
     except Exception as e:
         logging.exc(e, "Could not start: %s", json_str)
@@ -248,14 +548,199 @@ def start_effect_from_json(json_str):
     return None
 
 
+def bin2params(data):
+    """
+    Decode a binary command into the params an effect is started or updated with.
+
+    Args:
+        data (bytes): The binary command, see the module description.
+
+    Returns:
+        tuple: The effect ID and the params dict.
+
+    Raises:
+        ValueError: If the command is invalid.
+    """
+    mv = memoryview(data)
+    end = len(mv)
+    if end < struct.calcsize(BIN_HEADER):
+        raise ValueError("command shorter than the header")
+    version, effect_id, flags = struct.unpack_from(BIN_HEADER, mv)
+    if version != BIN_VERSION:
+        raise ValueError("unsupported version " + str(version))
+    params = {}
+    if flags & BIN_RESTART:
+        params["update"] = False
+    i = struct.calcsize(BIN_HEADER)
+    while i < end:
+        if i + 2 > end or i + 2 + mv[i + 1] > end:
+            raise ValueError("truncated parameter at " + str(i))
+        tag, n = mv[i], mv[i + 1]
+        i += 2
+        param = BIN_PARAMS.get(tag)
+        if param is not None:
+            name, kind = param
+            if kind == "c":
+                if n != 3:
+                    raise ValueError("color must be 3 bytes")
+                value = (mv[i], mv[i + 1], mv[i + 2])
+            elif kind == "s":
+                value = bytes(mv[i : i + n]).decode()
+            else:
+                if not 1 <= n <= 4:
+                    raise ValueError(name + " must be 1 to 4 bytes")
+                value = 0
+                for k in range(i, i + n):
+                    value = value << 8 | mv[k]
+            params[name] = value
+        i += n
+    return effect_id, params
+
+
+def start_effect_from_bin(data):
+    """
+    Start an effect from a binary command, or update the running one.
+
+    Args:
+        data (bytes): The binary command, see the module description.
+
+    Returns:
+        The result of the effect's start() or update() method, or None if not found.
+    """
+    try:
+        effect_id, params = bin2params(data)
+        if effect_id == BIN_RUNNING:
+            return update_effect(params)
+        effect = effect_by_name(_bin_effect_names.get(effect_id, ""))
+        if effect is None:
+            logging.warning("Effect ID not defined: %d", effect_id)
+            return None
+        return start_effect(effect, params)
+    except Exception as e:
+        logging.exc(e, "Could not start binary command: %s", bytes(data))
+    return None
+
+
+def pack_command(effect_name, params=None):
+    """
+    Return the binary command to start an effect with its params, e.g. for a controller.
+
+    Args:
+        effect_name (str): The name of the effect, or None to update the running effect.
+        params (dict, optional): The params. Those without a tag in BIN_PARAMS are left out.
+                                 "update": False sets the BIN_RESTART flag.
+
+    Returns:
+        bytes: The binary command.
+
+    Raises:
+        ValueError: If the effect has no ID in BIN_EFFECT_IDS, or a param is invalid.
+    """
+    params = params or {}
+    effect_id = BIN_RUNNING
+    if effect_name is not None:
+        effect = effect_by_name(effect_name)
+        effect_id = BIN_EFFECT_IDS.get(get_effect_name(effect) if effect is not None else None)
+        if effect_id is None:
+            raise ValueError("no effect ID for " + effect_name)
+    flags = BIN_RESTART if params.get("update", True) is False else 0
+    data = bytearray(struct.pack(BIN_HEADER, BIN_VERSION, effect_id, flags))
+    for tag, (name, kind) in BIN_PARAMS.items():
+        if name not in params:
+            continue
+        value = params[name]
+        if kind == "c":
+            value = bytes(parse_color(value))
+        elif kind == "s":
+            value = value.encode()
+        else:
+            value = int(value)
+            if not 0 <= value <= 0xFFFFFFFF:
+                raise ValueError(name + " must be 0 to 0xFFFFFFFF")
+            value = value.to_bytes(2 if value < 0x10000 else 4, "big")
+        if len(value) > 255:
+            raise ValueError(name + " is longer than 255 bytes")
+        data.append(tag)
+        data.append(len(value))
+        data.extend(value)
+    return bytes(data)
+
+
+def update_effect(params):
+    """
+    Update the parameters of the running effect in place, without restarting it.
+
+    Args:
+        params (dict): The parameters to change. Parameters not given keep their value.
+
+    Returns:
+        bool: True if updated, False if invalid or not all parameters can be changed in place,
+              or None if no effect is running.
+    """
+    if _current_effect is None:
+        logging.warning("No effect running to update.")
+        return None
+    if not _can_update(params):
+        logging.warning(
+            "%s cannot update %s in place.", _current_effect.__class__.__name__, list(params)
+        )
+        return False
+    try:
+        _current_effect.update(params)
+        return True
+    except Exception as e:
+        logging.exc(e, "Could not update %s.", _current_effect.__class__.__name__)
+        return False
+
+
 def mqtt_effect_handler(topic, msg):
-    """Handler for the /effect MQTT sub topic."""
-    msg = msg.decode().strip()
-    logging.info("From MQTT: %s - %s", topic, msg)
-    if topic == "effect":
+    """
+    Handler for the /effect (JSON) and /effect/bin (binary) MQTT sub topics.
+    The command is only kept, replacing a pending one, and applied by effect_loop().
+    """
+    global _pending, _pending_bin
+    is_bin = topic == "effect/bin"
+    if is_bin or topic == "effect":
+        _stats["commands"] += 1
+        if _pending is not None:
+            logging.debug("Effect command replaced: %s", _pending)
+        _pending = bytes(msg)
+        _pending_bin = is_bin
+
+
+def _apply_command():
+    """Start the effect of the pending effect command."""
+    global _pending, _last_apply, _holding
+    msg = _pending
+    _pending = None
+    _last_apply = ticks_ms()
+    _holding = True
+    _stats["applied"] += 1
+    if _pending_bin:
+        logging.debug("From MQTT: effect/bin - %s", msg)
+        start_effect_from_bin(msg)
+    else:
+        msg = msg.decode().strip()
+        logging.info("From MQTT: effect - %s", msg)
         start_effect_from_json(msg)
 
 
+def _can_update(params):
+    """Return True if the running effect can change all effect parameters in params in place."""
+    for key in params:
+        if key not in _COMMAND_PARAMS and key not in _current_effect.update_params:
+            return False
+    return True
+
+
+def _check_wait(wait):
+    """Return the wait time in ms as an int, raises ValueError if it is not positive."""
+    wait = int(wait)
+    if wait <= 0:
+        raise ValueError("wait must be positive")
+    return wait
+
+
 ###
 # Base class for all effects
 #
@@ -264,11 +749,15 @@ class EffectBase:
     Base class for all effects.
 
     Attributes:
+        update_params (tuple): The parameters update() changes in place. A command with other
+                               parameters restarts the effect.
         _matrix: The matrix object to apply the effect on.
-        _start_ms (int): Start time in milliseconds of current effect step.
+        _next_ms (int): Deadline in ticks_ms() of the next effect step.
         _wait (int): Wait time in milliseconds between updates.
     """
 
+    update_params = ("wait",)
+
     def __init__(self, matrix, params):
         """
         Initialize the base effect.
@@ -279,8 +768,8 @@ class EffectBase:
         """
         self._matrix = matrix
         self._params = params
-        self._start_ms = ticks_ms()
-        self._wait = params.get("wait", 100)
+        self._next_ms = ticks_ms()
+        self._wait = _check_wait(params.get("wait", 100))
 
     def start(self):
         """
@@ -290,13 +779,33 @@ class EffectBase:
             bool: True if the effect started successfully, False otherwise.
         """
         try:
-            self._start_ms = ticks_ms()
+            self._next_ms = ticks_add(ticks_ms(), self._wait)
             self.render()
             return True
         except Exception as e:
             logging.exc(e, "Could not start %s.", self.__class__.__name__)
             return False
 
+    def update(self, params):
+        """
+        Update the parameters of the running effect in place, keeping its animation state.
+        Effects with more parameters extend this and update_params: validate all changed
+        parameters first and then apply them, so an invalid update changes nothing, and call
+        super().update(params).
+
+        Args:
+            params (dict): The parameters to change. Parameters not given keep their value.
+
+        Raises:
+            ValueError: If a parameter is invalid.
+        """
+        if "wait" in params:
+            wait = _check_wait(params["wait"])
+            # Move the next deadline with the wait time, keeping the time since the last frame.
+            self._next_ms = ticks_add(self._next_ms, wait - self._wait)
+            self._wait = wait
+        self._params.update(params)
+
     def render(self):
         """
         Render the effect on the matrix.
@@ -317,12 +826,100 @@ class EffectBase:
         """
         Main loop to render and advance the effect based on the wait time.
 
-        This method checks if the wait time has passed, then calls the render and advance methods.
+        This method checks if the frame deadline has passed, then calls the render and advance
+        methods and sets the next deadline one wait time later, keeping a fixed cadence.
         """
-        if ticks_ms() > self._start_ms + self._wait:
-            self.render()
-            self.advance()
-            self._start_ms = ticks_ms()
+        late = ticks_diff(ticks_ms(), self._next_ms)
+        if late < 0:
+            return
+        self.render()
+        self.advance()
+        _stats["frames"] += 1
+        wait = max(1, self._wait)  # Never divide by zero below
+        if late >= wait:
+            _stats["overruns"] += 1
+            if _frame_policy == "drop" or late >= MAX_CATCHUP * wait:
+                # Skip the missed frames, keeping the cadence.
+                self._next_ms = ticks_add(self._next_ms, wait * (late // wait + 1))
+                return
+        self._next_ms = ticks_add(self._next_ms, wait)
+
+    def time_to_next(self):
+        """
+        Return the time in ms until the next frame is due, negative if overdue.
+        """
+        return ticks_diff(self._next_ms, ticks_ms())
+
+
+###
+# Transition between two running effects
+#
+class _Transition:
+    """
+    A running transition from an old effect to a new one.
+
+    Attributes:
+        _old: The effect that is being replaced.
+        _old_frame (bytearray): The off-screen frame of the old effect.
+        _new_frame (bytearray): The off-screen frame of the new effect.
+        _kind (str): The kind of transition, "fade" or "wipe".
+        _ms (int): The duration of the transition in milliseconds.
+        _start_ms (int): The start time of the transition.
+        _frame_ms (int): The time of the last blended frame.
+    """
+
+    def __init__(self, old, old_frame, new_frame, kind, ms):
+        self._old = old
+        self._old_frame = old_frame
+        self._new_frame = new_frame
+        self._kind = kind
+        self._ms = ms
+        self._start_ms = ticks_ms()
+        self._frame_ms = ticks_add(self._start_ms, -TRANSITION_FRAME_MS)
+
+    def loop(self, new):
+        """
+        Run both effects off-screen and show the blend of their frames.
+
+        Args:
+            new: The effect that is taking over.
+
+        Returns:
+            bool: True if the transition has finished.
+        """
+        m = _matrix
+        m.render_to(self._old_frame)
+        try:
+            self._old.loop()
+            m.render_to(self._new_frame)
+            new.loop()
+        finally:
+            m.render_to(None)
+
+        now = ticks_ms()
+        elapsed = ticks_diff(now, self._start_ms)
+        if elapsed >= self._ms:
+            m.buf[:] = self._new_frame
+            m.write()
+            return True
+        if ticks_diff(now, self._frame_ms) < TRANSITION_FRAME_MS:
+            return False
+        self._frame_ms = now
+        if self._kind == "fade":
+            crossfade(m.buf, self._old_frame, self._new_frame, elapsed, self._ms)
+        else:
+            # Wipe: the new frame covers the matrix column by column.
+            n = 3 * (m.size() * elapsed // self._ms)
+            frame = memoryview(m.buf)
+            frame[:n] = memoryview(self._new_frame)[:n]
+            frame[n:] = memoryview(self._old_frame)[n:]
+        m.write()
+        return False
+
+    def time_to_next(self, new):
+        """Return the time in ms until the next transition frame or effect frame is due."""
+        blend_ms = TRANSITION_FRAME_MS - ticks_diff(ticks_ms(), self._frame_ms)
+        return min(blend_ms, self._old.time_to_next(), new.time_to_next())
 
 
 ###
@@ -364,13 +961,91 @@ RAINBOW = (
 )
 
 
+###
+# Color palettes
+#
+# A palette is a bytearray with the colors packed as r, g, b byte triples. Effects can render
+# palette entries with matrix.set_index_palette() without any per-pixel arithmetic or allocation.
+#
+def pack_palette(colors):
+    """
+    Return a palette packed into a bytearray from a sequence of (r, g, b) colors.
+
+    Args:
+        colors: A sequence of (r, g, b) tuples.
+
+    Returns:
+        bytearray: The colors packed as r, g, b bytes.
+    """
+    palette = bytearray(3 * len(colors))
+    for i, (r, g, b) in enumerate(colors):
+        palette[3 * i] = r
+        palette[3 * i + 1] = g
+        palette[3 * i + 2] = b
+    return palette
+
+
+def palette_color(palette, index):
+    """
+    Return the color at index in a packed palette.
+
+    Args:
+        palette (bytearray): The packed palette.
+        index (int): The index of the color in the palette.
+
+    Returns:
+        tuple: A tuple representing the RGB color.
+    """
+    i = 3 * index
+    return (palette[i], palette[i + 1], palette[i + 2])
+
+
+def _wheel_palette():
+    """Return the 256 entry r - g - b - back to r color wheel as a packed palette."""
+    palette = bytearray(3 * 256)
+    for pos in range(256):
+        if pos < 85:
+            r, g, b = 255 - pos * 3, pos * 3, 0
+        elif pos < 170:
+            r, g, b = 0, 255 - (pos - 85) * 3, (pos - 85) * 3
+        else:
+            r, g, b = (pos - 170) * 3, 0, 255 - (pos - 170) * 3
+        palette[3 * pos] = r
+        palette[3 * pos + 1] = g
+        palette[3 * pos + 2] = b
+    return palette
+
+
+WHEEL = _wheel_palette()
+RAINBOW_PALETTE = pack_palette(RAINBOW)
+PALETTES = {
+    "rainbow": RAINBOW_PALETTE,
+    "wheel": WHEEL,
+}
+_wheel_colors = None  # WHEEL as color tuples, built by the first wheel() call
+
+
+def get_palette(name):
+    """
+    Return the named packed palette or None if not found.
+
+    Args:
+        name (str): The name of the palette, e.g. "wheel" or "rainbow".
+
+    Returns:
+        bytearray: The packed palette, or None.
+    """
+    return PALETTES.get(name.lower())
+
+
 ###
 # Utility functions
 #
 def wheel(pos):
     """
     Input a value 0 to 255 to get a color value.
-    The colors are a transition r - g - b - back to r.
+    The colors are a transition r - g - b - back to r, the WHEEL palette as color tuples. These are
+    built on the first call only, so boards whose effects never use wheel() do not hold them.
 
     Args:
         pos (int): Position in the color wheel (0-255).
@@ -378,15 +1053,12 @@ def wheel(pos):
     Returns:
         tuple: A tuple representing the RGB color.
     """
+    global _wheel_colors
     if pos < 0 or pos > 255:
         return (0, 0, 0)
-    if pos < 85:
-        return (255 - pos * 3, pos * 3, 0)
-    if pos < 170:
-        pos -= 85
-        return (0, 255 - pos * 3, pos * 3)
-    pos -= 170
-    return (pos * 3, 0, 255 - pos * 3)
+    if _wheel_colors is None:
+        _wheel_colors = tuple(palette_color(WHEEL, i) for i in range(256))
+    return _wheel_colors[pos]
 
 
 def random_color(color_list=RAINBOW):
@@ -404,43 +1076,52 @@ def random_color(color_list=RAINBOW):
 
 def full_help():
     """
-    Return a string with the help for all effects.
+    Return a string with the help for all effects. It is built once and then cached.
 
     Returns:
         str: A string with the help for all effects.
     """
-    help_lines = [f"Available effects: {", ".join(all_effect_names())}.\n"]
-    for e in get_effects():
-        name = get_effect_name(e)
-        help_lines.append(f"{name}: {get_effect_purpose(e)}")
-        help_lines.append(f"{'':{len(name)+1}} {get_effect_json(e)}")
-    return "\n".join(help_lines)
+    global _help_text
+
+    if _help_text is None:
+        names = ", ".join(_effect_names)
+        help_lines = [f"Available effects: {names}.\n"]
+        for name, e in zip(_effect_names, _effects):
+            effect_id = BIN_EFFECT_IDS.get(name)
+            id_text = "" if effect_id is None else f" (ID {effect_id})"
+            help_lines.append(f"{name}{id_text}: {get_effect_purpose(e)}")
+            help_lines.append(f"{'':{len(name)+1}} {get_effect_json(e)}")
+        _help_text = "\n".join(help_lines)
+    return _help_text
 
 
 def text2color(params, default_color_rgb=(255, 0, 0)):
     """
     Get the color string from the params dict and convert it to a color setting.
+    The color can be "(r,g,b)", "#rrggbb", a name or "hsv(h,s,v)", see colors.parse_color().
+    Binary commands have the color as a tuple already.
 
     Args:
         params (dict): The parameters to get the color from.
+        default_color_rgb (tuple): The color if there is none or it is invalid.
 
     Returns:
         tuple: The color as a tuple (r, g, b).
     """
+    color = params.get("color")
+    if color is None:
+        return default_color_rgb
     try:
-        color = params.get("color", f"{default_color_rgb}")
-        color_rgb = eval(color)
-        if not isinstance(color_rgb, tuple) or len(color_rgb) != 3:
-            raise TypeError(f'"color" must be a stringified tuple of three integers, not "{color_rgb}".')
-    except TypeError as e:
-        logging.exc(e, "Cannot convert color setting, setting to {default_color_rgb}}")
-        color_rgb = default_color_rgb
-    return color_rgb
+        return parse_color(color)
+    except (TypeError, ValueError) as e:
+        logging.exc(e, "Cannot convert color setting %s, setting to %s", color, default_color_rgb)
+        return default_color_rgb
 
 
-def fader(fade_index: int, fade_max : int, fade_from, fade_to):
+def fader(fade_index: int, fade_max: int, fade_from, fade_to):
     """
     Fade from one color/set to an other.
+    Whole frames are faded much faster with pixellib.crossfade().
 
     Args:
         fade_index (int): The current fade step.
@@ -451,13 +1132,18 @@ def fader(fade_index: int, fade_max : int, fade_from, fade_to):
     Returns:
         tuple: The color as a tuple (r, g, b).
     """
+    fade_inv = fade_max - fade_index
     if isinstance(fade_from, tuple) and isinstance(fade_to, tuple):
-        #print(f"fade tuples {fade_index}, {fade_max}, {fade_from}, {fade_to}")
-        return tuple([fader(fade_index, fade_max, fade_from[i], fade_to[i]) for i in range(min(len(fade_from), len(fade_to)))])
+        if len(fade_from) == 3 and len(fade_to) == 3 and isinstance(fade_from[0], int):
+            # The common case of a single color, no per channel calls
+            r0, g0, b0 = fade_from
+            r1, g1, b1 = fade_to
+            return (
+                round((r0 * fade_inv + r1 * fade_index) / fade_max),
+                round((g0 * fade_inv + g1 * fade_index) / fade_max),
+                round((b0 * fade_inv + b1 * fade_index) / fade_max),
+            )
+        return tuple(fader(fade_index, fade_max, f, t) for f, t in zip(fade_from, fade_to))
     if isinstance(fade_from, list) and isinstance(fade_to, list):
-        #print(f"fade tuples {fade_index}, {fade_max}, {fade_from}, {fade_to}")
-        return [fader(fade_index, fade_max, fade_from[i], fade_to[i]) for i in range(min(len(fade_from), len(fade_to)))]  
-    else:
-        #print(f"fade floats {fade_index}, {fade_max}, {fade_from}, {fade_to}")
-        return round(((fade_from * (fade_max - fade_index)) + (fade_to * fade_index)) / fade_max)
-    
+        return [fader(fade_index, fade_max, f, t) for f, t in zip(fade_from, fade_to)]
+    return round((fade_from * fade_inv + fade_to * fade_index) / fade_max)
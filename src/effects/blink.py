@@ -4,6 +4,7 @@ from . import EffectBase
 class Blink(EffectBase):
     
     help_purpose = "blinking lights, choose between patches and rows."
+    update_params = ("wait", "style")
     
     def __init__(self, matrix, params):
         
@@ -17,12 +18,21 @@ class Blink(EffectBase):
         self.color_2 = (13, 50, 8)
         self.color_3 = (3, 13, 50)
         self.color_4 = (128, 20, 18)
-        
+
+        self._set_indices()
+
+    def _set_indices(self):
         if self.style == "row":
             self.indices = (0, 2, 3, 5, 6, 8, 9, 11)
         else:
             self.indices = (0, 2, 4, 6, 8, 10)
 
+    def update(self, params):
+        super().update(params)
+        if "style" in params:
+            self.style = params["style"]
+            self._set_indices()
+
     def advance(self):
         self.timestep += 1
         if self.timestep % 5 == 0:
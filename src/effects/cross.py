@@ -5,7 +5,6 @@ Maintainer: Sensemakers Amsterdam  https://sensemakersams.org
 """
 
 from . import EffectBase, text2color
-import senselogging as logging
 
 
 class Cross(EffectBase):
@@ -22,6 +21,7 @@ class Cross(EffectBase):
 
     help_purpose = "Display a red cross on the matrix."
     help_json = '{ "effect": "cross", "color": "(200,0,0)", "wait": 500 }'
+    update_params = ("wait", "color")
 
     def __init__(self, matrix, params):
         """
@@ -36,6 +36,17 @@ class Cross(EffectBase):
         self._wait = params.get("wait", 500)
         self._color = text2color(params)
 
+    def update(self, params):
+        """
+        Update the color and wait time in place.
+
+        Args:
+            params: The parameters to change.
+        """
+        color = text2color(params, self._color) if "color" in params else self._color
+        super().update(params)
+        self._color = color
+
     def render(self):
         """
         Render the cross effect on the matrix.
@@ -19,6 +19,7 @@ class Cycle(EffectBase):
 
     help_purpose = "Cycle through the matrix."
     help_json = '{ "effect": "cycle", "color": "(200,30,4)" }'
+    update_params = ("wait", "color")
 
     def __init__(self, matrix, params):
         """
@@ -32,6 +33,17 @@ class Cycle(EffectBase):
         self._index = 0
         self._color = text2color(params)
 
+    def update(self, params):
+        """
+        Update the color and wait time in place.
+
+        Args:
+            params: The parameters to change.
+        """
+        color = text2color(params, self._color) if "color" in params else self._color
+        super().update(params)
+        self._color = color
+
     def advance(self):
         """
         Advance the cycle effect by incrementing the index.
@@ -4,7 +4,7 @@ Author: Karijn Wessing, Sensemakers Amsterdam
 Maintainer: Sensemakers Amsterdam  https://sensemakersams.org
 """
 
-from . import EffectBase, RAINBOW
+from . import RAINBOW, RAINBOW_PALETTE, EffectBase
 
 
 class Rainbow(EffectBase):
@@ -14,7 +14,7 @@ class Rainbow(EffectBase):
     Attributes:
         help_purpose (str): Description of the effect's purpose.
         help_json (str): JSON representation of the effect.
-        rainbow (list): List of colors representing the rainbow.
+        shift (int): The number of positions the rainbow has rotated.
         start_ms (int): Start time in milliseconds.
     """
 
@@ -29,21 +29,23 @@ class Rainbow(EffectBase):
             params: Additional parameters for the effect.
         """
         super().__init__(matrix, params)
-        self._rainbow = list(RAINBOW)
+        self._shift = 0
 
     def advance(self):
         """
         Advance the rainbow effect by rotating the colors.
         """
-        self._rainbow = self._rainbow[-1:] + self._rainbow[:-1]
+        self._shift = (self._shift + 1) % len(RAINBOW)
 
     def render(self):
         """
         Render the rainbow effect on the matrix.
         """
         m = self._matrix
+        shift = self._shift
+        n = len(RAINBOW)
         for i in range(m.size()):
-            m.set_index(i, self._rainbow[i])
+            m.set_index_palette(i, RAINBOW_PALETTE, (i - shift) % n)
         m.write()
 
 
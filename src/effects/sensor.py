@@ -7,9 +7,17 @@ Maintainer: Sensemakers Amsterdam  https://sensemakersams.org
 import machine
 import veml7700
 
-from . import EffectBase, text2color
+from . import EffectBase
 
-i2c = machine.I2C(1, scl=machine.Pin(1), sda=machine.Pin(0), freq=10000)
+_i2c = None  # The I2C bus of the light sensor, created when the effect is first used
+
+
+def get_i2c():
+    """Return the I2C bus of the light sensor, creating it on first use."""
+    global _i2c
+    if _i2c is None:
+        _i2c = machine.I2C(1, scl=machine.Pin(1), sda=machine.Pin(0), freq=10000)
+    return _i2c
 
 
 class Sensor(EffectBase):
@@ -38,7 +46,7 @@ class Sensor(EffectBase):
         super().__init__(matrix, params)
         self._is_on = True
         self._wait = params.get("wait", 500)
-        self.veml = veml7700.VEML7700(address=0x10, i2c=i2c, it=100, gain=1 / 8)
+        self.veml = veml7700.VEML7700(address=0x10, i2c=get_i2c(), it=100, gain=1 / 8)
         # self._color = text2color(params)
         self._color = (0, 0, 0)
 
@@ -3,7 +3,7 @@ wheel_loop.py -  WheelLoop effect class.
 Author: Karijn Wessing, Sensemakers Amsterdam
 Maintainer: Sensemakers Amsterdam  https://sensemakersams.org
 """
-from effects import EffectBase, wheel
+from effects import WHEEL, EffectBase
 
 
 class WheelLoop(EffectBase):
@@ -14,6 +14,7 @@ class WheelLoop(EffectBase):
         help_purpose (str): Description of the effect's purpose.
         help_json (str): JSON representation of the effect.
         index (int): Current index for the wheel effect.
+        base (bytes): The wheel position of every pixel at index 0.
     """
 
     help_purpose = "Cycle through the matrix with a wheel effect."
@@ -28,6 +29,8 @@ class WheelLoop(EffectBase):
         """
         super().__init__(matrix, params)
         self._index = 0
+        msize = matrix.size()
+        self._base = bytes((i * 256 // msize) & 255 for i in range(msize))
 
     def advance(self):
         """
@@ -43,10 +46,10 @@ class WheelLoop(EffectBase):
         Render the wheel effect on the matrix.
         """
         m = self._matrix
-        msize = m.size()
-        for i in range(msize):
-            rc_index = (i * 256 // msize) + self._index
-            m.set_index(i, wheel(rc_index & 255))
+        base = self._base
+        index = self._index
+        for i in range(len(base)):
+            m.set_index_palette(i, WHEEL, (base[i] + index) & 255)
         m.write()
 
 
@@ -2,7 +2,7 @@
 xmas_tree.py - Display a red cross on the matrix
 """
 
-from . import EffectBase, random_color, fader, wheel
+from . import EffectBase, random_color, fader, text2color, wheel
 from random import randint
 
 
@@ -20,6 +20,7 @@ class XmasTree(EffectBase):
 
     help_purpose = "Display the Tree, it's outline, and ornament on the matrix."
     help_json = '{ "effect": "xmastree", "color": "(200,0,0)", "wait": 500 }'
+    update_params = ("wait", "color")
 
     def __init__(self, matrix, params):
         """
@@ -33,7 +34,7 @@ class XmasTree(EffectBase):
         self._matrix.clear()
         self._is_on = True
         self._wait = params.get("wait", 500)
-        self._color = eval(params.get("color", "(0, 255, 0)"))
+        self._color = text2color(params, (0, 255, 0))
         self._treecolors = [(0,128,0),
                             (0,100,0),
                             (17,139,17),
@@ -57,7 +58,18 @@ class XmasTree(EffectBase):
 #             self.ornament_start[col] = (0, 0, 0)
 #             self.ornament_running[col] = False
         self.ornament_end    = (0, 0, 0)
-        
+
+    def update(self, params):
+        """
+        Update the color and wait time in place.
+
+        Args:
+            params: The parameters to change.
+        """
+        color = text2color(params, self._color) if "color" in params else self._color
+        super().update(params)
+        self._color = color
+
     def render(self):
         """
         Render the cross effect on the matrix.
@@ -0,0 +1,164 @@
+"""
+Description: This module parses color settings, e.g. the "color" parameter of effects, without eval().
+A color can be given as:
+- "(r,g,b)", "[r,g,b]" or "r,g,b" with r, g and b from 0 to 255, e.g. "(200,0,0)".
+- "#rrggbb" or "#rgb" in hex, e.g. "#c80000".
+- A name in NAMED_COLORS, case insensitive, ignoring spaces, "-" and "_", e.g. "Warm White".
+- "hsv(h,s,v)" with the hue h from 0 to 360 degrees and the saturation s and value v from 0 to 100,
+  e.g. "hsv(120,100,50)".
+A tuple or list of three integers is accepted as well.
+
+The parsed colors of the last CACHE_SIZE strings are cached, so a color that is set repeatedly,
+e.g. by a controller over MQTT, is only parsed once. The cache is least recently used first out.
+
+Author: Gijs Mos, Sensemakers Amsterdam
+Maintainer: Sensemakers Amsterdam  https://sensemakersams.org
+
+Functions:
+- parse_color(color): Return the color as an (r, g, b) tuple, raises ValueError if invalid.
+- hsv2rgb(h, s, v): Return the (r, g, b) tuple of a color given as hue, saturation and value.
+"""
+
+CACHE_SIZE = 16  # Number of parsed color strings kept
+
+# Color name -> (r, g, b). Names are lower case without spaces, "-" and "_".
+NAMED_COLORS = {
+    "black": (0, 0, 0),
+    "off": (0, 0, 0),
+    "white": (255, 255, 255),
+    "warmwhite": (255, 180, 100),
+    "red": (255, 0, 0),
+    "darkred": (139, 0, 0),
+    "orange": (255, 100, 0),
+    "gold": (255, 180, 0),
+    "yellow": (255, 255, 0),
+    "lime": (0, 255, 0),
+    "green": (0, 128, 0),
+    "darkgreen": (0, 100, 0),
+    "forestgreen": (34, 139, 34),
+    "cyan": (0, 255, 255),
+    "teal": (0, 128, 128),
+    "blue": (0, 0, 255),
+    "navy": (0, 0, 128),
+    "purple": (128, 0, 128),
+    "violet": (148, 0, 211),
+    "magenta": (255, 0, 255),
+    "pink": (255, 105, 180),
+    "silver": (192, 192, 192),
+}
+
+_HEX_DIGITS = "0123456789abcdef"  # The color string is lower case when checked
+
+_cache = {}  # holds the color string -> (r, g, b) of the recently parsed colors
+_lru = []  # holds the color strings in _cache, the least recently used first
+
+
+def _ints(values):
+    """Return the tuple of three integers, raises ValueError if invalid."""
+    if len(values) != 3:
+        raise ValueError("a color needs 3 values")
+    return tuple(int(v) for v in values)
+
+
+def _rgb(values):
+    """Return the tuple of three integers from 0 to 255, raises ValueError if invalid."""
+    r, g, b = _ints(values)
+    if not (0 <= r <= 255 and 0 <= g <= 255 and 0 <= b <= 255):
+        raise ValueError("color values must be 0 to 255")
+    return (r, g, b)
+
+
+def hsv2rgb(h, s, v):
+    """
+    Return the (r, g, b) tuple of a color given as hue, saturation and value.
+
+    Args:
+        h (int): The hue in degrees, 0 to 360.
+        s (int): The saturation, 0 to 100.
+        v (int): The value, 0 to 100.
+
+    Returns:
+        tuple: The color as (r, g, b).
+    """
+    h = h % 360
+    v = v * 255 // 100
+    c = v * s // 100  # The chroma
+    x = c * (60 - abs(h % 120 - 60)) // 60
+    m = v - c
+    sector = h // 60
+    if sector == 0:
+        r, g, b = c, x, 0
+    elif sector == 1:
+        r, g, b = x, c, 0
+    elif sector == 2:
+        r, g, b = 0, c, x
+    elif sector == 3:
+        r, g, b = 0, x, c
+    elif sector == 4:
+        r, g, b = x, 0, c
+    else:
+        r, g, b = c, 0, x
+    return (r + m, g + m, b + m)
+
+
+def _parse(text):
+    """Parse a color string, see the module description."""
+    s = text.strip().lower()
+    if s.startswith("#"):
+        for c in s[1:]:
+            if c not in _HEX_DIGITS:  # int() would also take signs, e.g. "#-1ffff"
+                raise ValueError("hex colors have hex digits only")
+        if len(s) == 4:
+            return tuple(int(c, 16) * 17 for c in s[1:])
+        if len(s) == 7:
+            return tuple(int(s[i : i + 2], 16) for i in (1, 3, 5))
+        raise ValueError("hex colors are #rrggbb or #rgb")
+    if s.startswith("hsv"):
+        s = s[3:].strip()
+        if not (s.startswith("(") and s.endswith(")")):
+            raise ValueError("hsv colors are hsv(h,s,v)")
+        h, sat, v = _ints(s[1:-1].split(","))
+        if not (0 <= h <= 360 and 0 <= sat <= 100 and 0 <= v <= 100):
+            raise ValueError("hsv values are 0 to 360, 0 to 100 and 0 to 100")
+        return hsv2rgb(h, sat, v)
+    first = s[:1]
+    if first and first in "([0123456789":
+        if first in "([":
+            if s[-1] != (")" if first == "(" else "]"):
+                raise ValueError("unbalanced brackets")
+            s = s[1:-1]
+        return _rgb(s.split(","))
+    name = s.replace(" ", "").replace("-", "").replace("_", "")
+    color = NAMED_COLORS.get(name)
+    if color is None:
+        raise ValueError("unknown color name")
+    return color
+
+
+def parse_color(color):
+    """
+    Return the color as an (r, g, b) tuple.
+
+    Args:
+        color (str, tuple or list): The color, in one of the formats in the module description.
+
+    Returns:
+        tuple: The color as (r, g, b).
+
+    Raises:
+        ValueError: If the color is invalid.
+    """
+    if not isinstance(color, str):
+        return _rgb(color)
+    rgb = _cache.get(color)
+    if rgb is not None:
+        if _lru[-1] != color:
+            _lru.remove(color)
+            _lru.append(color)
+        return rgb
+    rgb = _parse(color)
+    if len(_lru) >= CACHE_SIZE:
+        del _cache[_lru.pop(0)]
+    _cache[color] = rgb
+    _lru.append(color)
+    return rgb
@@ -21,6 +21,11 @@ class GFX:
         #  - vline = A function to quickly draw a vertical line on the display.
         #            This should take at least an x, y, and height paraemter and
         #            any number of optional color or other parameters.
+        #  A primitive called with just a color, either as the only extra
+        #  positional argument or as the color keyword, passes that color on as
+        #  the third positional argument of pixel (fourth of hline and vline).
+        #  The color is bound once per primitive instead of forwarding *args and
+        #  **kwargs on every pixel.
         self.width = width
         self.height = height
         self._pixel = pixel
@@ -35,52 +40,115 @@ class GFX:
         else:
             self.vline = vline
 
+    def _bind_pixel(self, args, kwargs):
+        # Return pixel, color such that pixel(x, y, color) draws a pixel with the
+        # extra arguments of a primitive.
+        if not kwargs and len(args) == 1:
+            return self._pixel, args[0]
+        if not args and len(kwargs) == 1 and "color" in kwargs:
+            return self._pixel, kwargs["color"]
+        pixel = self._pixel
+        return (lambda x, y, _: pixel(x, y, *args, **kwargs)), None
+
+    def _bind_line(self, line, args, kwargs):
+        # Return line, color such that line(x, y, length, color) draws a
+        # horizontal or vertical line with the extra arguments of a primitive.
+        if not kwargs and len(args) == 1:
+            return line, args[0]
+        if not args and len(kwargs) == 1 and "color" in kwargs:
+            return line, kwargs["color"]
+        return (lambda x, y, n, _: line(x, y, n, *args, **kwargs)), None
+
     def _slow_hline(self, x0, y0, width, *args, **kwargs):
         # Slow implementation of a horizontal line using pixel drawing.
         # This is used as the default horizontal line if no faster override
-        # is provided.
-        if y0 < 0 or y0 > self.height or x0 < -width or x0 > self.width:
+        # is provided.  The span is clipped to the drawing area first.
+        if y0 < 0 or y0 >= self.height:
             return
-        for i in range(width):
-            self._pixel(x0 + i, y0, *args, **kwargs)
+        if x0 < 0:
+            width += x0
+            x0 = 0
+        width = min(width, self.width - x0)
+        pixel, color = self._bind_pixel(args, kwargs)
+        for x in range(x0, x0 + width):
+            pixel(x, y0, color)
 
     def _slow_vline(self, x0, y0, height, *args, **kwargs):
         # Slow implementation of a vertical line using pixel drawing.
         # This is used as the default vertical line if no faster override
-        # is provided.
-        if y0 < -height or y0 > self.height or x0 < 0 or x0 > self.width:
+        # is provided.  The span is clipped to the drawing area first.
+        if x0 < 0 or x0 >= self.width:
             return
-        for i in range(height):
-            self._pixel(x0, y0 + i, *args, **kwargs)
+        if y0 < 0:
+            height += y0
+            y0 = 0
+        height = min(height, self.height - y0)
+        pixel, color = self._bind_pixel(args, kwargs)
+        for y in range(y0, y0 + height):
+            pixel(x0, y, color)
+
+    def _outside(self, x0, y0, width, height):
+        # True if the width x height box at x0, y0 misses the drawing area.
+        return (
+            width <= 0
+            or height <= 0
+            or x0 >= self.width
+            or y0 >= self.height
+            or x0 + width <= 0
+            or y0 + height <= 0
+        )
+
+    def _clip_pixel(self, pixel):
+        # Wrap pixel for shapes that are partly outside the drawing area.
+        width = self.width
+        height = self.height
+
+        def clipped(x, y, color):
+            if 0 <= x < width and 0 <= y < height:
+                pixel(x, y, color)
+
+        return clipped
 
     def rect(self, x0, y0, width, height, *args, **kwargs):
         # Rectangle drawing function.  Will draw a single pixel wide rectangle
         # starting in the upper left x0, y0 position and width, height pixels in
         # size.
-        if y0 < -height or y0 > self.height or x0 < -width or x0 > self.width:
+        if self._outside(x0, y0, width, height):
             return
-        self.hline(x0, y0, width, *args, **kwargs)
-        self.hline(x0, y0 + height - 1, width, *args, **kwargs)
-        self.vline(x0, y0, height, *args, **kwargs)
-        self.vline(x0 + width - 1, y0, height, *args, **kwargs)
+        hline, color = self._bind_line(self.hline, args, kwargs)
+        vline, color = self._bind_line(self.vline, args, kwargs)
+        hline(x0, y0, width, color)
+        hline(x0, y0 + height - 1, width, color)
+        vline(x0, y0, height, color)
+        vline(x0 + width - 1, y0, height, color)
 
     def fill_rect(self, x0, y0, width, height, *args, **kwargs):
         # Filled rectangle drawing function.  Will draw a single pixel wide
         # rectangle starting in the upper left x0, y0 position and width, height
-        # pixels in size.
-        if y0 < -height or y0 > self.height or x0 < -width or x0 > self.width:
+        # pixels in size.  The rectangle is clipped to the drawing area once.
+        if self._outside(x0, y0, width, height):
             return
-        for i in range(x0, x0 + width):
-            self.vline(i, y0, height, *args, **kwargs)
+        if y0 < 0:
+            height += y0
+            y0 = 0
+        height = min(height, self.height - y0)
+        vline, color = self._bind_line(self.vline, args, kwargs)
+        for i in range(max(x0, 0), min(x0 + width, self.width)):
+            vline(i, y0, height, color)
 
     def line(self, x0, y0, x1, y1, *args, **kwargs):
         # Line drawing function.  Will draw a single pixel wide line starting at
         # x0, y0 and ending at x1, y1.
+        # The line is clipped to the drawing area before it is drawn, such that
+        # exactly the pixels of the unclipped line that are visible get drawn.
         # print(f"line: ({x0}, {y0}) -> ({x1}, {y1}) a:{args} kw:{kwargs}")
         steep = abs(y1 - y0) > abs(x1 - x0)
         if steep:
             x0, y0 = y0, x0
             x1, y1 = y1, x1
+            x_size, y_size = self.height, self.width
+        else:
+            x_size, y_size = self.width, self.height
         if x0 > x1:
             x0, x1 = x1, x0
             y0, y1 = y1, y0
@@ -92,11 +160,37 @@ class GFX:
             ystep = 1
         else:
             ystep = -1
+        # Step k of the line draws x = x0 + k, y = y0 + ystep * m, where
+        # m = -((err - k * dy) // dx) is the number of y steps taken so far.
+        # Find the range of k for which both x and y are within the drawing area.
+        k_lo = max(0, -x0)
+        k_hi = min(dx, x_size - 1 - x0)
+        if ystep > 0:
+            m_lo, m_hi = -y0, y_size - 1 - y0
+        else:
+            m_lo, m_hi = y0 - y_size + 1, y0
+        if dy == 0:
+            if m_lo > 0 or m_hi < 0:
+                return
+        else:
+            if m_lo > 0:
+                k_lo = max(k_lo, (err - (1 - m_lo) * dx) // dy + 1)
+            k_hi = min(k_hi, (err + m_hi * dx) // dy)
+        if k_lo > k_hi:
+            return
+        # Start the walk at step k_lo.
+        if k_lo:
+            m = -((err - k_lo * dy) // dx)
+            err += m * dx - k_lo * dy
+            y0 += ystep * m
+            x0 += k_lo
+        x1 = x0 + k_hi - k_lo
+        pixel, color = self._bind_pixel(args, kwargs)
         while x0 <= x1:
             if steep:
-                self._pixel(y0, x0, *args, **kwargs)
+                pixel(y0, x0, color)
             else:
-                self._pixel(x0, y0, *args, **kwargs)
+                pixel(x0, y0, color)
             err -= dy
             if err < 0:
                 y0 += ystep
@@ -106,15 +200,23 @@ class GFX:
     def circle(self, x0, y0, radius, *args, **kwargs):
         # Circle drawing function.  Will draw a single pixel wide circle with
         # center at x0, y0 and the specified radius.
+        size = 2 * radius + 1
+        if self._outside(x0 - radius, y0 - radius, size, size):
+            return
+        pixel, color = self._bind_pixel(args, kwargs)
+        if self._outside(x0 - radius, y0 - radius, 1, 1) or self._outside(
+            x0 + radius, y0 + radius, 1, 1
+        ):
+            pixel = self._clip_pixel(pixel)  # Partly visible, check every point
         f = 1 - radius
         ddF_x = 1
         ddF_y = -2 * radius
         x = 0
         y = radius
-        self._pixel(x0, y0 + radius, *args, **kwargs)
-        self._pixel(x0, y0 - radius, *args, **kwargs)
-        self._pixel(x0 + radius, y0, *args, **kwargs)
-        self._pixel(x0 - radius, y0, *args, **kwargs)
+        pixel(x0, y0 + radius, color)
+        pixel(x0, y0 - radius, color)
+        pixel(x0 + radius, y0, color)
+        pixel(x0 - radius, y0, color)
         while x < y:
             if f >= 0:
                 y -= 1
@@ -123,19 +225,27 @@ class GFX:
             x += 1
             ddF_x += 2
             f += ddF_x
-            self._pixel(x0 + x, y0 + y, *args, **kwargs)
-            self._pixel(x0 - x, y0 + y, *args, **kwargs)
-            self._pixel(x0 + x, y0 - y, *args, **kwargs)
-            self._pixel(x0 - x, y0 - y, *args, **kwargs)
-            self._pixel(x0 + y, y0 + x, *args, **kwargs)
-            self._pixel(x0 - y, y0 + x, *args, **kwargs)
-            self._pixel(x0 + y, y0 - x, *args, **kwargs)
-            self._pixel(x0 - y, y0 - x, *args, **kwargs)
+            pixel(x0 + x, y0 + y, color)
+            pixel(x0 - x, y0 + y, color)
+            pixel(x0 + x, y0 - y, color)
+            pixel(x0 - x, y0 - y, color)
+            pixel(x0 + y, y0 + x, color)
+            pixel(x0 - y, y0 + x, color)
+            pixel(x0 + y, y0 - x, color)
+            pixel(x0 - y, y0 - x, color)
 
     def fill_circle(self, x0, y0, radius, *args, **kwargs):
         # Filled circle drawing function.  Will draw a filled circule with
         # center at x0, y0 and the specified radius.
-        self.vline(x0, y0 - radius, 2 * radius + 1, *args, **kwargs)
+        # Columns outside the drawing area are skipped, the vertical spans
+        # are clipped by vline.
+        size = 2 * radius + 1
+        if self._outside(x0 - radius, y0 - radius, size, size):
+            return
+        width = self.width
+        vline, color = self._bind_line(self.vline, args, kwargs)
+        if 0 <= x0 < width:
+            vline(x0, y0 - radius, size, color)
         f = 1 - radius
         ddF_x = 1
         ddF_y = -2 * radius
@@ -149,10 +259,14 @@ class GFX:
             x += 1
             ddF_x += 2
             f += ddF_x
-            self.vline(x0 + x, y0 - y, 2 * y + 1, *args, **kwargs)
-            self.vline(x0 + y, y0 - x, 2 * x + 1, *args, **kwargs)
-            self.vline(x0 - x, y0 - y, 2 * y + 1, *args, **kwargs)
-            self.vline(x0 - y, y0 - x, 2 * x + 1, *args, **kwargs)
+            if 0 <= x0 + x < width:
+                vline(x0 + x, y0 - y, 2 * y + 1, color)
+            if 0 <= x0 + y < width:
+                vline(x0 + y, y0 - x, 2 * x + 1, color)
+            if 0 <= x0 - x < width:
+                vline(x0 - x, y0 - y, 2 * y + 1, color)
+            if 0 <= x0 - y < width:
+                vline(x0 - y, y0 - x, 2 * x + 1, color)
 
     def triangle(self, x0, y0, x1, y1, x2, y2, *args, **kwargs):
         # Triangle drawing function.  Will draw a single pixel wide triangle
@@ -173,10 +287,13 @@ class GFX:
         if y0 > y1:
             y0, y1 = y1, y0
             x0, x1 = x1, x0
+        if self._outside(
+            min(x0, x1, x2), y0, max(x0, x1, x2) - min(x0, x1, x2) + 1, y2 - y0 + 1
+        ):
+            return
+        hline, color = self._bind_line(self.hline, args, kwargs)
         a = 0
         b = 0
-        y = 0
-        last = 0
         if y0 == y2:
             a = x0
             b = x0
@@ -188,7 +305,7 @@ class GFX:
                 a = x2
             elif x2 > b:
                 b = x2
-            self.hline(a, y0, b - a + 1, *args, **kwargs)
+            hline(a, y0, b - a + 1, color)
             return
         dx01 = x1 - x0
         dy01 = y1 - y0
@@ -202,28 +319,23 @@ class GFX:
             dy02 = 1
         if dy12 == 0:
             dy12 = 1
-        sa = 0
-        sb = 0
+        last = 0
         if y1 == y2:
             last = y1
         else:
             last = y1 - 1
-        for y in range(y0, last + 1):
-            a = x0 + sa // dy01
-            b = x0 + sb // dy02
-            sa += dx01
-            sb += dx02
+        # Only the scanlines within the drawing area are computed.
+        y_lo = max(y0, 0)
+        y_hi = min(y2, self.height - 1)
+        for y in range(y_lo, min(last, y_hi) + 1):
+            a = x0 + dx01 * (y - y0) // dy01
+            b = x0 + dx02 * (y - y0) // dy02
             if a > b:
                 a, b = b, a
-            self.hline(a, y, b - a + 1, *args, **kwargs)
-        sa = dx12 * (y - y1)
-        sb = dx02 * (y - y0)
-        while y <= y2:
-            a = x1 + sa // dy12
-            b = x0 + sb // dy02
-            sa += dx12
-            sb += dx02
+            hline(a, y, b - a + 1, color)
+        for y in range(max(last + 1, y_lo), y_hi + 1):
+            a = x1 + dx12 * (y - y1) // dy12
+            b = x0 + dx02 * (y - y0) // dy02
             if a > b:
                 a, b = b, a
-            self.hline(a, y, b - a + 1, *args, **kwargs)
-            y += 1
+            hline(a, y, b - a + 1, color)
@@ -0,0 +1,182 @@
+"""
+Description: This module loads the app modules from a bundle of precompiled .mpy files, and builds
+that bundle on the host. Importing from .mpy files skips the compilation of the sources at boot,
+which makes the boot faster and avoids the heap fragmentation caused by the compiler.
+
+The bundle is a directory (BUNDLE_DIR) with the .mpy files of the sources in SOURCES and of all
+effects, in the same package layout as on the device but with the lib/ prefix removed, and a
+BUNDLE_MANIFEST file with the SHA256 hashes of the sources it was built from. The bundle is only
+put in front of sys.path when all these hashes match the sources on the device, no effects were
+added or removed, and the .mpy version matches the firmware. Otherwise the sources are used.
+
+Build the bundle on the host from the src directory, with mpy-cross of the firmware version, and
+upload the mpy directory along with the sources:
+    python lib/mpybundle.py -march=xtensawin
+The -march option is needed for the viper code in pixellib, use the architecture of the board.
+
+Author: Gijs Mos, Sensemakers Amsterdam
+Maintainer: Sensemakers Amsterdam  https://sensemakersams.org
+
+Functions:
+- source_files(root=""): Return the paths of the sources that go into the bundle.
+- file_hash(path): Return the SHA256 hash of the file as a hex string.
+- bundle_check(root="", bundle_dir=BUNDLE_DIR): Return None if the bundle matches the sources, else the reason why not.
+- activate(root="", bundle_dir=BUNDLE_DIR): Put the bundle in front of sys.path if it matches the sources.
+- deactivate(bundle_dir=BUNDLE_DIR): Remove the bundle from sys.path.
+- build(root="", bundle_dir=BUNDLE_DIR, mpy_cross="mpy-cross", args=()): Build the bundle on the host.
+"""
+
+import sys
+from binascii import hexlify
+from hashlib import sha256
+from os import listdir, stat
+
+BUNDLE_DIR = "mpy"  # The directory with the bundle, relative to the root of the app
+BUNDLE_MANIFEST = "bundle.json"  # The hashes of the sources in the bundle directory
+SOURCES = (
+    "connectivity.py",
+    "lib/colors.py",
+    "lib/gfx.py",
+    "lib/pixellib.py",
+    "lib/settings.py",
+    "lib/veml7700.py",
+    "lib/senselogging/__init__.py",
+    "lib/senselogging/handlers.py",
+    "lib/sensemqtt/simple.py",
+    "lib/sensemqtt/robust.py",
+)  # The sources in the bundle besides the effects package
+EFFECTS_DIR = "effects"  # All .py files in this package go into the bundle
+_CHUNK = 512  # Bytes read at a time when hashing
+
+
+def _join(root, path):
+    return root + "/" + path if root else path
+
+
+def source_files(root=""):
+    """Return the paths of the sources that go into the bundle, relative to root."""
+    effects = sorted(f for f in listdir(_join(root, EFFECTS_DIR)) if f.endswith(".py"))
+    return list(SOURCES) + [EFFECTS_DIR + "/" + f for f in effects]
+
+
+def _mpy_path(source):
+    """Return the path of the .mpy file of the source, relative to the bundle directory."""
+    if source.startswith("lib/"):
+        source = source[4:]
+    return source[:-3] + ".mpy"
+
+
+def file_hash(path):
+    """Return the SHA256 hash of the file as a hex string."""
+    h = sha256()
+    buf = bytearray(_CHUNK)
+    mv = memoryview(buf)
+    with open(path, "rb") as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            h.update(mv[:n])
+    return hexlify(h.digest()).decode()
+
+
+def _mpy_version():
+    """Return the .mpy version of the firmware, or None if not known (e.g. on the host)."""
+    mpy = getattr(sys.implementation, "_mpy", None)
+    return None if mpy is None else mpy & 0xFF
+
+
+def bundle_check(root="", bundle_dir=BUNDLE_DIR):
+    """
+    Check if the bundle matches the sources.
+
+    Args:
+        root (str, optional): The root directory of the app. Defaults to the current directory.
+        bundle_dir (str, optional): The bundle directory relative to root. Defaults to BUNDLE_DIR.
+
+    Returns:
+        str: None if the bundle can be used, otherwise the reason why not.
+    """
+    import json
+
+    bundle = _join(root, bundle_dir)
+    try:
+        with open(bundle + "/" + BUNDLE_MANIFEST) as f:
+            hashes = json.load(f)["hashes"]
+    except Exception:
+        return "no bundle"
+    sources = source_files(root)
+    if sorted(hashes) != sorted(sources):
+        return "sources added or removed"
+    version = _mpy_version()
+    for source in sources:
+        mpy = bundle + "/" + _mpy_path(source)
+        try:
+            with open(mpy, "rb") as f:
+                header = f.read(2)
+        except OSError:
+            return "missing " + mpy
+        if header[:1] != b"M" or (version is not None and header[1] != version):
+            return "wrong .mpy version " + mpy
+        if file_hash(_join(root, source)) != hashes[source]:
+            return "changed " + source
+    return None
+
+
+def activate(root="", bundle_dir=BUNDLE_DIR):
+    """
+    Put the bundle in front of sys.path if it matches the sources, so the app modules are imported
+    from the .mpy files. Must be called before any of the app modules is imported, e.g. in boot.py.
+
+    Returns:
+        bool: True if the bundle is used.
+    """
+    reason = bundle_check(root, bundle_dir)
+    if reason is not None:
+        print(f"Not using the precompiled bundle: {reason}.")
+        return False
+    path = _join(root, bundle_dir)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+    print(f"Using the precompiled bundle in {path}.")
+    return True
+
+
+def deactivate(bundle_dir=BUNDLE_DIR):
+    """Remove the bundle from sys.path. Modules imported already are not affected."""
+    for path in [p for p in sys.path if p == bundle_dir or p.endswith("/" + bundle_dir)]:
+        sys.path.remove(path)
+
+
+def build(root="", bundle_dir=BUNDLE_DIR, mpy_cross="mpy-cross", args=()):
+    """
+    Build the bundle on the host: compile all sources with mpy-cross and write the manifest.
+
+    Args:
+        root (str, optional): The src directory. Defaults to the current directory.
+        bundle_dir (str, optional): The bundle directory relative to root. Defaults to BUNDLE_DIR.
+        mpy_cross (str, optional): The mpy-cross command. Defaults to "mpy-cross".
+        args (sequence, optional): Extra mpy-cross options, e.g. ("-march=xtensawin",).
+    """
+    import json
+    import os
+    import subprocess
+
+    bundle = _join(root, bundle_dir)
+    hashes = {}
+    for source in source_files(root):
+        mpy = bundle + "/" + _mpy_path(source)
+        os.makedirs(mpy.rsplit("/", 1)[0], exist_ok=True)
+        # The source name is kept in the .mpy file for tracebacks.
+        subprocess.run(
+            [mpy_cross] + list(args) + ["-s", source, "-o", mpy, _join(root, source)], check=True
+        )
+        hashes[source] = file_hash(_join(root, source))
+        print(f"{source} -> {mpy} ({stat(mpy)[6]} bytes)")
+    with open(bundle + "/" + BUNDLE_MANIFEST, "w") as f:
+        json.dump({"hashes": hashes}, f)
+    print(f"Bundle of {len(hashes)} modules written to {bundle}.")
+
+
+if __name__ == "__main__":
+    build(args=sys.argv[1:])
@@ -4,6 +4,24 @@ Description: This module provides a class to handle a NeoPixel matrix.
 Author: Gijs Mos, Sensemakers Amsterdam
 Maintainer: Sensemakers Amsterdam  https://sensemakersams.org
 
+The matrix renders into its own frame buffer: a flat bytearray holding the pixels in GRB wire
+order, column by column. A lookup table maps (row, col) to the byte offset of a pixel, so pixel
+writes are plain byte stores. write() copies the whole frame to the NeoPixel strip in one step.
+A copy of the last transmitted frame is kept, so write() can skip frames that did not change.
+
+The GFX drawing primitives use x for the row and y for the column. As the pixels are stored
+column by column, a GFX horizontal line is one contiguous span of the frame buffer. The native
+hline/vline and fill implementations fill such spans with a few slice copies.
+
+Drawing can be redirected to an off-screen frame buffer with render_to(). While drawing
+off-screen write() transmits nothing, so an effect can render without showing its frames.
+
+Global brightness and gamma correction are applied when a frame is written, through a 256 entry
+lookup table. Effects render full-range colors; changing the brightness only rebuilds the table.
+
+Functions:
+- crossfade(dst, src_from, src_to, fade_index, fade_max): Blend two frames or palettes into dst.
+
 Classes:
 - NeoPixMatrix: A class to handle a NeoPixel matrix with various utility methods.
 
@@ -11,19 +29,71 @@ Methods:
 - __init__(self, neo_pixels, n_cols, n_rows, n_start=0): Initialize the NeoPixMatrix.
 - _row_col_to_n(self, row, col): Convert row and column to a single index.
 - set_pix(self, row, col, color=(0, 0, 0), show=False): Set the color of a specific pixel.
+- get_pix(self, row, col): Return the color of a specific pixel.
 - set_index(self, index, color=(0, 0, 0), show=False): Set the color of a specific pixel by index.
+- set_index_palette(self, index, palette, entry, show=False): Set a pixel by index to a palette entry.
 - set_row(self, row, color=(0, 0, 0), show=False): Set the color of an entire row.
 - set_col(self, col, color=(0, 0, 0), show=False): Set the color of an entire column.
+- fill(self, color=(0, 0, 0), row=0, col=0, n_rows=None, n_cols=None, show=False): Fill (part of) the matrix.
+- fill_rect(self, x0, y0, width, height, color=(0, 0, 0)): GFX filled rectangle using fill().
+- new_frame(self): Return a new, black, off-screen frame buffer for this matrix.
+- render_to(self, frame=None): Draw into an off-screen frame buffer, or back into the matrix frame.
+- set_brightness(self, brightness=1.0, gamma=1.0): Set the output brightness and gamma correction.
 - clear(self, show=True): Clear the entire matrix by setting all pixels to the clear color.
-- write(self): Update the display.
+- write(self, force=False): Update the display, unless the frame did not change.
 - size(self): Return the total number of pixels in the matrix.
 """
 
+import micropython
 import neopixel
 from gfx import GFX
 from time import sleep_ms
 from machine import Pin
 
+
+@micropython.viper
+def _lut_copy(dst, src, lut, n: int):
+    """Copy n bytes from src to dst, translating each byte through lut."""
+    d = ptr8(dst)
+    s = ptr8(src)
+    t = ptr8(lut)
+    for i in range(n):
+        d[i] = t[s[i]]
+
+
+@micropython.viper
+def _blend(dst, a, b, weight: int, n: int):
+    """Blend n bytes of a and b into dst, weight is the share of b in 1/65536ths."""
+    d = ptr8(dst)
+    pa = ptr8(a)
+    pb = ptr8(b)
+    inv = 65536 - weight
+    for i in range(n):
+        d[i] = (pa[i] * inv + pb[i] * weight + 32768) >> 16
+
+
+def crossfade(dst, src_from, src_to, fade_index, fade_max):
+    """Blend two frames (or two packed palettes) into dst in a single pass.
+
+    The bytes follow the same fade as effects.fader() does for single colors, but computed in
+    16 bit fixed point, so they may differ by one in rounding: step fade_index of fade_max is
+    src_from at 0 and src_to at fade_max.
+
+    Args:
+        dst (bytearray): The buffer to write the result to, may be one of the sources.
+        src_from (bytearray): The frame at fade_index 0.
+        src_to (bytearray): The frame at fade_index fade_max.
+        fade_index (int): The current fade step.
+        fade_max (int): The number of fade steps.
+
+    Returns:
+        None
+    """
+    n = min(len(dst), len(src_from), len(src_to))
+    weight = (fade_index * 65536 + fade_max // 2) // fade_max
+    _blend(dst, src_from, src_to, min(max(weight, 0), 65536), n)
+
+
 class NeoPixMatrix(GFX):
     BLUE = (0, 0, 255)
     CLEAR = (0, 0, 0)
@@ -44,17 +114,38 @@ class NeoPixMatrix(GFX):
         Returns:
             None
         """
-        super().__init__(n_cols, n_rows, self.set_pix)
+        # GFX x runs along the rows, y along the columns.
+        super().__init__(n_rows, n_cols, self.set_pix, self._gfx_hline, self._gfx_vline)
         # Check the construction arguments
         assert isinstance(neo_pixels, neopixel.NeoPixel), "No NeoPixel matrix passed."
         assert 0 < n_rows <= 100, f"Illegal n_rows: {n_rows}."
         assert 0 < n_cols <= 100, f"Illegal n_cols: {n_cols}."
         # assert n_rows * n_cols == neo_pixels.n, "N rows/cols does not match matrix."
+        assert neo_pixels.bpp == 3, "Only RGB NeoPixels are supported."
+        assert (n_start + n_rows * n_cols) <= neo_pixels.n, "Matrix does not fit the NeoPixels."
         # Set our attributes.
         self.pix = neo_pixels
         self.n_rows = n_rows
         self.n_cols = n_cols
         self.n_start = n_start
+        # The frame buffer in GRB wire order and the (row, col) -> byte offset lookup table.
+        self.buf = bytearray(3 * n_rows * n_cols)
+        self._buf_mv = memoryview(self.buf)
+        self._frame = self.buf  # The frame buffer that is transmitted by write()
+        self.offscreen = False
+        self._offsets = tuple(
+            tuple(3 * (col * n_rows + row) for col in range(n_cols)) for row in range(n_rows)
+        )
+        # The part of the NeoPixel buffer that this matrix covers.
+        self._pix_buf = memoryview(neo_pixels.buf)[3 * n_start : 3 * n_start + len(self.buf)]
+        # The last frame sent to the NeoPixels and the write statistics.
+        self._shown = None
+        self.frames_written = 0
+        self.frames_skipped = 0
+        # Output lookup table for brightness and gamma, None when it is the identity.
+        self.brightness = 1.0
+        self.gamma = 1.0
+        self._lut = None
 
     def _row_col_to_n(self, row, col):
         """Convert row and column to a single index.
@@ -83,10 +174,26 @@ class NeoPixMatrix(GFX):
         if row < 0 or col < 0 or row >= self.n_rows or col >= self.n_cols:
             return
         # print(f" set ({col}, {row}) to {color}")
-        self.pix[self._row_col_to_n(row, col)] = color
+        o = self._offsets[row][col]
+        buf = self.buf
+        buf[o + 1], buf[o], buf[o + 2] = color
         if show:
             self.write()
 
+    def get_pix(self, row, col):
+        """Return the color of a specific pixel.
+
+        Args:
+            row (int): The row index of the pixel.
+            col (int): The column index of the pixel.
+
+        Returns:
+            tuple: The (r, g, b) color of the pixel.
+        """
+        o = self._offsets[row][col]
+        buf = self.buf
+        return (buf[o + 1], buf[o], buf[o + 2])
+
     def set_index(self, index, color=(0, 0, 0), show=False):
         """Set the color of a specific pixel.
 
@@ -98,7 +205,30 @@ class NeoPixMatrix(GFX):
         Returns:
             None
         """
-        self.pix[index + self.n_start] = color
+        o = 3 * index
+        buf = self.buf
+        buf[o + 1], buf[o], buf[o + 2] = color
+        if show:
+            self.write()
+
+    def set_index_palette(self, index, palette, entry, show=False):
+        """Set the color of a specific pixel to an entry of a packed palette.
+
+        Args:
+            index (int): The index of the pixel.
+            palette (bytearray): The colors packed as r, g, b bytes.
+            entry (int): The index of the color in the palette.
+            show (bool, optional): Whether to update the display immediately. Defaults to False.
+
+        Returns:
+            None
+        """
+        o = 3 * index
+        p = 3 * entry
+        buf = self.buf
+        buf[o] = palette[p + 1]
+        buf[o + 1] = palette[p]
+        buf[o + 2] = palette[p + 2]
         if show:
             self.write()
 
@@ -113,8 +243,7 @@ class NeoPixMatrix(GFX):
         Returns:
             None
         """
-        for c in range(self.n_cols):
-            self.set_pix(row, c, color)
+        self._gfx_vline(row, 0, self.n_cols, color)
         if show:
             self.write()
 
@@ -129,11 +258,64 @@ class NeoPixMatrix(GFX):
         Returns:
             None
         """
-        for r in range(self.n_rows):
-            self.set_pix(r, col, color)
+        self._gfx_hline(0, col, self.n_rows, color)
         if show:
             self.write()
 
+    def new_frame(self):
+        """Return a new, black, off-screen frame buffer for this matrix.
+
+        Returns:
+            bytearray: A frame buffer of the size of the matrix frame buffer.
+        """
+        return bytearray(len(self._frame))
+
+    def render_to(self, frame=None):
+        """Redirect all drawing to an off-screen frame buffer.
+
+        While drawing off-screen write() transmits nothing.
+
+        Args:
+            frame (bytearray, optional): A buffer from new_frame(), or None to draw into the
+                matrix frame buffer again. Defaults to None.
+
+        Returns:
+            None
+        """
+        if frame is None:
+            frame = self._frame
+        assert len(frame) == len(self._frame), "Frame size does not match the matrix."
+        self.buf = frame
+        self._buf_mv = memoryview(frame)
+        self.offscreen = frame is not self._frame
+
+    def set_brightness(self, brightness=1.0, gamma=1.0):
+        """Set the output brightness and gamma correction.
+
+        Every color channel value v is sent as brightness * 255 * (v / 255) ** gamma.
+        The lookup table is rebuilt and the next frame is always transmitted.
+
+        Args:
+            brightness (float, optional): The brightness from 0.0 to 1.0. Defaults to 1.0.
+            gamma (float, optional): The gamma correction exponent. Defaults to 1.0.
+
+        Returns:
+            None
+        """
+        brightness = min(max(brightness, 0.0), 1.0)
+        assert gamma > 0, f"Illegal gamma: {gamma}."
+        # Build the table before changing anything, so an invalid value (e.g. a NaN brightness)
+        # leaves the brightness, gamma and table as they were.
+        lut = None
+        if brightness != 1.0 or gamma != 1.0:
+            lut = bytearray(256)
+            for v in range(256):
+                lut[v] = int(brightness * 255 * (v / 255) ** gamma + 0.5)
+        self.brightness = brightness
+        self.gamma = gamma
+        self._lut = lut
+        self._shown = None
+
     def clear(self, show=True):
         """Clear the entire matrix by setting all pixels to the clear color.
 
@@ -143,18 +325,130 @@ class NeoPixMatrix(GFX):
         Returns:
             None
         """
-        if 0 == self.n_start:
-            self.pix.fill(self.CLEAR)
-        else:
-            for i in range(self.size()):
-                self.set_index(i, self.CLEAR)
+        self._fill_span(0, len(self.buf), self.CLEAR)
+        if show:
+            self.write()
+
+    def fill(self, color=(0, 0, 0), row=0, col=0, n_rows=None, n_cols=None, show=False):
+        """Fill the matrix, or a rectangular part of it, with a single color.
+
+        Args:
+            color (tuple, optional): The color to fill with. Defaults to (0, 0, 0).
+            row (int, optional): The first row to fill. Defaults to 0.
+            col (int, optional): The first column to fill. Defaults to 0.
+            n_rows (int, optional): The number of rows to fill. Defaults to all remaining rows.
+            n_cols (int, optional): The number of columns to fill. Defaults to all remaining columns.
+            show (bool, optional): Whether to update the display immediately. Defaults to False.
+
+        Returns:
+            None
+        """
+        if n_rows is None:
+            n_rows = self.n_rows - row
+        if n_cols is None:
+            n_cols = self.n_cols - col
+        # Clip the rectangle to the matrix.
+        if row < 0:
+            n_rows += row
+            row = 0
+        if col < 0:
+            n_cols += col
+            col = 0
+        n_rows = min(n_rows, self.n_rows - row)
+        n_cols = min(n_cols, self.n_cols - col)
+        if n_rows > 0 and n_cols > 0:
+            start = self._offsets[row][col]
+            if n_rows == self.n_rows:
+                # Whole columns are one contiguous span.
+                self._fill_span(start, start + 3 * n_rows * n_cols, color)
+            else:
+                step = 3 * self.n_rows
+                for o in range(start, start + step * n_cols, step):
+                    self._fill_span(o, o + 3 * n_rows, color)
         if show:
             self.write()
 
-    def write(self):
+    def fill_rect(self, x0, y0, width, height, color=(0, 0, 0)):
+        """GFX filled rectangle, with x0 the first row and y0 the first column."""
+        self.fill(color, x0, y0, width, height)
+
+    def _fill_span(self, start, end, color):
+        """Fill the frame buffer bytes start up to end with color.
+
+        The first pixel is stored and then copied onto the rest of the span in doubling chunks.
+        """
+        if end <= start:
+            return
+        buf = self.buf
+        buf[start + 1], buf[start], buf[start + 2] = color
+        mv = self._buf_mv
+        size = end - start
+        n = 3
+        while n < size:
+            k = min(n, size - n)
+            mv[start + n : start + n + k] = mv[start : start + k]
+            n += k
+
+    def _gfx_hline(self, x0, y0, width, color=(0, 0, 0)):
+        """GFX horizontal line: width rows from row x0 down column y0, one contiguous span."""
+        if y0 < 0 or y0 >= self.n_cols:
+            return
+        if x0 < 0:
+            width += x0
+            x0 = 0
+        width = min(width, self.n_rows - x0)
+        if width > 0:
+            start = self._offsets[x0][y0]
+            self._fill_span(start, start + 3 * width, color)
+
+    def _gfx_vline(self, x0, y0, height, color=(0, 0, 0)):
+        """GFX vertical line: height columns from column y0 along row x0."""
+        if x0 < 0 or x0 >= self.n_rows:
+            return
+        if y0 < 0:
+            height += y0
+            y0 = 0
+        height = min(height, self.n_cols - y0)
+        if height > 0:
+            r, g, b = color
+            buf = self.buf
+            step = 3 * self.n_rows
+            start = self._offsets[x0][y0]
+            for o in range(start, start + step * height, step):
+                buf[o] = g
+                buf[o + 1] = r
+                buf[o + 2] = b
+
+    def write(self, force=False):
+        """Copy the frame buffer to the NeoPixels and update the display.
+
+        The transmission is skipped if the frame is identical to the last one sent, or when
+        drawing off-screen.
+
+        Args:
+            force (bool, optional): Transmit even if the frame did not change. Defaults to False.
+
+        Returns:
+            bool: True if the frame was transmitted, False if not.
+        """
+        if self.offscreen:
+            return False
+        buf = self.buf
+        if not force and buf == self._shown:
+            self.frames_skipped += 1
+            return False
+        if self._shown is None:
+            self._shown = bytearray(len(buf))
+        self._shown[:] = buf
+        if self._lut is None:
+            self._pix_buf[:] = buf
+        else:
+            _lut_copy(self._pix_buf, buf, self._lut, len(buf))
         self.pix.pin.off()
         sleep_ms(1)
         self.pix.write()
+        self.frames_written += 1
+        return True
 
     def size(self):
         return self.n_rows * self.n_cols
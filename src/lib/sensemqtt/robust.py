@@ -1,14 +1,67 @@
 # Modified version of logging module from MicroPython.  Gijs Mos,  Sensemakers Amsterdam
+#
+# Reconnecting MQTT client that never waits for the broker. A connect attempt opens a
+# non-blocking socket, and later check_msg() or reconnect() calls send the CONNECT packet when
+# the TCP connection is up and complete the connection when the CONNACK has arrived, or fail the
+# attempt after CONNECT_TIMEOUT. After a connection failure the next connect attempt is scheduled
+# with capped exponential backoff and jitter, and made when it is due. A connection whose
+# PINGRESP is overdue is treated as lost (see simple.py for the keepalive). stats() returns the
+# connection state and counters for monitoring.
+#
+# Still blocking: the DNS lookup of the broker, once, and again after a failed attempt (none for
+# an IP address), and with ssl the TLS handshake, up to CONNECT_TIMEOUT each.
+#
+# publish() only queues the message (at most QUEUE_SIZE, the oldest are dropped). The queue is
+# sent by flush(), which check_msg() calls, so it is drained from the main loop or an async task.
+# Queued packets are packed into one socket write of at most TX_SIZE bytes; a larger publish is
+# sent on its own, as QoS 0. Up to INFLIGHT QoS 1 publishes wait for their PUBACK at the same
+# time, and are sent again after a reconnect. A write that does not complete within
+# WRITE_TIMEOUT_MS (see simple.py) drops the connection, so the broker never sees a partial packet
+# followed by the next one.
+import errno
+import select
+import socket
 import time
+from random import getrandbits
+
 from . import simple
 
+DISCONNECTED = "disconnected"  # Not connected, the next attempt is due at once
+BACKOFF = "backoff"  # Not connected, waiting for the next attempt
+CONNECTING = "connecting"  # Waiting for the TCP connection or the CONNACK
+CONNECTED = "connected"
+
 
 class MQTTClient(simple.MQTTClient):
-    DELAY = 2
+    BACKOFF_MIN_MS = 1000  # Wait after the first failure
+    BACKOFF_MAX_MS = 60000  # Maximum wait between attempts
+    CONNECT_TIMEOUT = 5  # Time in seconds a connect attempt may take
+    QUEUE_SIZE = 10  # Publishes waiting to be sent
+    TX_SIZE = 512  # Size of the send buffer that packets are packed in
+    INFLIGHT = 4  # QoS 1 publishes waiting for their PUBACK
     DEBUG = False
 
-    def delay(self, i):
-        time.sleep(self.DELAY)
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.state = DISCONNECTED
+        self.clean_session = False
+        self._next_attempt = 0  # ticks_ms() of the next connect attempt, or of its deadline
+        self._addr = None  # Address of the broker, looked up again after a failed attempt
+        self._poller = None  # Polls the socket while connecting
+        self._backoff = 0  # Current backoff in ms, 0 after a successful connect
+        self._queue = []  # (topic, msg, retain, qos) of publishes to send
+        self._inflight = {}  # pid -> (topic, msg, retain) of QoS 1 publishes without PUBACK
+        self._tx = bytearray(self.TX_SIZE)  # The send buffer
+        self.counters = {
+            "attempts": 0,
+            "failures": 0,
+            "connects": 0,
+            "drops": 0,
+            "dropped": 0,
+            "sent": 0,
+            "writes": 0,
+            "resent": 0,
+        }
 
     def log(self, in_reconnect, e):
         if self.DEBUG:
@@ -17,38 +70,240 @@ class MQTTClient(simple.MQTTClient):
             else:
                 print("mqtt: %r" % e)
 
+    def isconnected(self):
+        return self.state == CONNECTED
+
+    def stats(self):
+        """
+        Return a dict with the connection state, the counters, the backoff, the queued and in
+        flight publishes, and the round trip time of the last ping.
+        """
+        stats = dict(self.counters)
+        stats["state"] = self.state
+        stats["backoff_ms"] = self._backoff
+        stats["queued"] = len(self._queue)
+        stats["inflight"] = len(self._inflight)
+        stats["rtt_ms"] = self.rtt_ms
+        stats["ping_timeouts"] = self.ping_timeouts
+        return stats
+
+    def connect(self, clean_session=True, timeout=None):
+        # The session flag is kept for the reconnects.
+        self.clean_session = clean_session
+        self._next_attempt = time.ticks_ms()
+        return self.reconnect()
+
+    def _connection_lost(self, e):
+        """Close the socket and schedule a reconnect with backoff."""
+        self.log(False, e)
+        if self.state == CONNECTED:
+            self.counters["drops"] += 1
+        self._close()
+        self._schedule()
+
+    def _close(self):
+        try:
+            self.sock.close()
+        except Exception:
+            pass
+
+    def _schedule(self):
+        """Schedule the next connect attempt: double the backoff, capped, with jitter."""
+        self._backoff = min(self.BACKOFF_MAX_MS, max(self.BACKOFF_MIN_MS, 2 * self._backoff))
+        # Wait between half and all of the backoff, so clients that lost the broker together
+        # do not all come back at the same time.
+        half = self._backoff // 2
+        delay = half + half * getrandbits(8) // 256
+        self._next_attempt = time.ticks_add(time.ticks_ms(), delay)
+        self.state = BACKOFF
+
     def reconnect(self):
-        i = 0
-        while 1:
-            try:
-                return super().connect(False)
-            except OSError as e:
-                self.log(True, e)
-                i += 1
-                self.delay(i)
+        """
+        Start a connect attempt if one is due, or advance the attempt in progress.
+        Never waits for the broker. Returns True if connected.
+        """
+        if self.state == CONNECTED:
+            return True
+        try:
+            if self.state != CONNECTING:
+                if time.ticks_diff(self._next_attempt, time.ticks_ms()) > 0:
+                    return False
+                self.counters["attempts"] += 1
+                self._start_connect()
+            if not self._poll_connect():
+                return False
+            self._resend()
+        except Exception as e:
+            # Also a bad CONNACK, a timeout, or an error in the on connect callback
+            self.counters["failures"] += 1
+            self.log(True, e)
+            self._addr = None
+            self._poller = None
+            self._close()
+            self._schedule()
+            return False
+        self._poller = None
+        self.state = CONNECTED
+        self._backoff = 0
+        self.counters["connects"] += 1
+        self.flush()
+        return self.state == CONNECTED
+
+    def _start_connect(self):
+        """Open a non-blocking socket to the broker, the TCP connection completes later."""
+        if self._addr is None:
+            self._addr = socket.getaddrinfo(self.server, self.port)[0][-1]
+        self.sock = socket.socket()
+        self.sock.setblocking(False)
+        self._rx_len = self._rx_skip = 0
+        try:
+            self.sock.connect(self._addr)
+        except OSError as e:
+            if e.errno != errno.EINPROGRESS:
+                raise
+        self._poller = select.poll()
+        self._poller.register(self.sock, select.POLLOUT)
+        self._next_attempt = time.ticks_add(time.ticks_ms(), self.CONNECT_TIMEOUT * 1000)
+        self.state = CONNECTING
+
+    def _poll_connect(self):
+        """
+        Send the CONNECT packet when the TCP connection is up, and complete the connection when
+        the CONNACK has arrived. Returns True when connected, raises OSError on timeout.
+        Packets that arrive right after the CONNACK stay in the receive buffer for check_msg().
+        """
+        events = self._poller.poll(0)
+        if not events:
+            if time.ticks_diff(time.ticks_ms(), self._next_attempt) >= 0:
+                raise OSError(errno.ETIMEDOUT)
+            return False
+        if events[0][1] & (select.POLLERR | select.POLLHUP):
+            raise OSError(errno.ECONNREFUSED)
+        # The packets are small, so the socket only blocks on a slow TLS handshake.
+        self.sock.settimeout(self.CONNECT_TIMEOUT)
+        if events[0][1] & select.POLLOUT:
+            if self.ssl:
+                self.sock = self.ssl.wrap_socket(self.sock, server_hostname=self.server)
+                self._poller = select.poll()
+                self._poller.register(self.sock, select.POLLIN)
+            else:
+                self._poller.modify(self.sock, select.POLLIN)
+            self._send_connect(self.clean_session)
+            self.sock.setblocking(False)
+            return False
+        # The CONNACK is read into the receive buffer like any packet, so it may arrive in parts.
+        self._recv(False)
+        if self._rx_len < 4:
+            return False
+        resp = self._rx[:4]
+        self._consume(4)
+        self._connack(resp)
+        return True
 
     def publish(self, topic, msg, retain=False, qos=0):
-        while 1:
-            try:
-                return super().publish(topic, msg, retain, qos)
-            except OSError as e:
-                self.log(False, e)
-            self.reconnect()
+        # Only queues the message, flush() sends it.
+        assert qos < 2
+        if len(self._queue) >= self.QUEUE_SIZE:
+            self._queue.pop(0)
+            self.counters["dropped"] += 1
+        self._queue.append((topic, msg, retain, qos))
 
-    def wait_msg(self):
-        while 1:
-            try:
-                return super().wait_msg()
-            except OSError as e:
-                self.log(False, e)
-            self.reconnect()
+    def _pack(self, pos, topic, msg, retain, qos, pid, dup=False):
+        """
+        Put a PUBLISH packet in the send buffer at pos.
+        Returns the position after it, or -1 if it does not fit.
+        """
+        sz = 2 + len(topic) + len(msg) + (2 if qos else 0)
+        end = pos + 1 + (1 if sz < 0x80 else (2 if sz < 0x4000 else 3)) + sz
+        if end > self.TX_SIZE:
+            return -1
+        tx = self._tx
+        tx[pos] = 0x30 | dup << 3 | qos << 1 | retain
+        pos += 1
+        while sz > 0x7F:
+            tx[pos] = (sz & 0x7F) | 0x80
+            sz >>= 7
+            pos += 1
+        tx[pos] = sz
+        tx[pos + 1] = len(topic) >> 8
+        tx[pos + 2] = len(topic) & 0xFF
+        pos += 3
+        tx[pos : pos + len(topic)] = topic
+        pos += len(topic)
+        if qos:
+            tx[pos] = pid >> 8
+            tx[pos + 1] = pid & 0xFF
+            pos += 2
+        tx[pos:end] = msg
+        return end
 
-    def check_msg(self, attempts=2):
-        while attempts:
-            self.sock.setblocking(False)
-            try:
-                return super().wait_msg()
-            except OSError as e:
-                self.log(False, e)
+    def _write(self, n):
+        """Write the first n bytes of the send buffer, whole, see _send()."""
+        self._send(self._tx, n)
+        self.last_tx = time.ticks_ms()
+        self.counters["writes"] += 1
+
+    def flush(self):
+        """
+        Send the queued publishes, packed into as few socket writes as possible. QoS 1 publishes
+        wait in the queue while INFLIGHT publishes wait for their PUBACK.
+        """
+        if self.state != CONNECTED:
+            return
+        try:
+            while self._queue:
+                pos = n = 0
+                for topic, msg, retain, qos in self._queue:
+                    if qos and len(self._inflight) >= self.INFLIGHT:
+                        break
+                    pid = self.pid % 65535 + 1 if qos else 0
+                    end = self._pack(pos, topic, msg, retain, qos, pid)
+                    if end < 0:
+                        break
+                    if qos:
+                        self.pid = pid
+                        self._inflight[pid] = (topic, msg, retain)
+                    pos = end
+                    n += 1
+                if n:
+                    self._write(pos)
+                else:
+                    topic, msg, retain, qos = self._queue[0]
+                    if qos and len(self._inflight) >= self.INFLIGHT:
+                        return
+                    super().publish(topic, msg, retain)  # Too large for the send buffer
+                    n = 1
+                del self._queue[:n]
+                self.counters["sent"] += n
+        except OSError as e:
+            self._connection_lost(e)
+
+    def _resend(self):
+        """Send the QoS 1 publishes without PUBACK again, with the DUP flag."""
+        pos = 0
+        for pid, (topic, msg, retain) in self._inflight.items():
+            end = self._pack(pos, topic, msg, retain, 1, pid, True)
+            if end < 0:
+                self._write(pos)
+                end = self._pack(0, topic, msg, retain, 1, pid, True)
+            pos = end
+            self.counters["resent"] += 1
+        if pos:
+            self._write(pos)
+
+    def _puback_received(self, pid):
+        super()._puback_received(pid)
+        self._inflight.pop(pid, None)
+
+    def check_msg(self):
+        # Makes a connect attempt instead when disconnected and it is due.
+        if self.state != CONNECTED:
             self.reconnect()
-            attempts -= 1
\ No newline at end of file
+            return None
+        try:
+            res = super().check_msg()
+        except OSError as e:
+            self._connection_lost(e)
+            return None
+        self.flush()
+        return res
@@ -1,6 +1,29 @@
 # Modified version of logging module from MicroPython.  Gijs Mos,  Sensemakers Amsterdam
+#
+# Incoming packets are read without blocking into a preallocated receive buffer with readinto(),
+# and parsed incrementally: a packet that arrives in parts is completed by later calls of
+# check_msg(). Polling while nothing arrives allocates nothing. The topic and message of a PUBLISH
+# are passed to the callback as memoryviews into the receive buffer, so the payload is never
+# copied into a new object. They are only valid during the callback. PUBLISH packets larger than
+# RX_SIZE are skipped.
+#
+# The allocations per message are small memoryview objects, never the size of the payload: the two
+# passed to the callback, one more for reading the rest of a packet that arrived in parts, and two
+# per chunk that _consume() moves when bytes of later packets are buffered behind the message.
+#
+# With a keepalive set, check_msg() sends a PINGREQ when nothing was sent for 0.75 keepalive, and
+# raises OSError when the PINGRESP does not arrive within PING_TIMEOUT_MS. The round trip time of
+# the last ping is kept in rtt_ms.
+#
+# check_msg() leaves the socket non-blocking, where a write can be short or send nothing. Packets
+# are written with _send(), which waits for room to write the rest, for at most WRITE_TIMEOUT_MS,
+# and raises OSError when it does not fit in time. Then the packet is cut off, and the connection
+# has to be dropped.
+import errno
+import select
 import socket
 import struct
+import time
 
 
 class MQTTException(Exception):
@@ -8,6 +31,10 @@ class MQTTException(Exception):
 
 
 class MQTTClient:
+    RX_SIZE = 1024  # Size of the receive buffer, the largest packet that can be received
+    PING_TIMEOUT_MS = 5000  # The link is dead when a PINGRESP takes longer
+    WRITE_TIMEOUT_MS = 2000  # Time a packet write may wait for room in the socket
+
     def __init__(
         self,
         client_id,
@@ -35,20 +62,39 @@ class MQTTClient:
         self.lw_msg = None
         self.lw_qos = 0
         self.lw_retain = False
+        self._rx = bytearray(self.RX_SIZE)  # The receive buffer
+        self._rxmv = memoryview(self._rx)
+        self._rx_len = 0  # Bytes in the receive buffer
+        self._rx_skip = 0  # Bytes still to skip of a packet too large for the receive buffer
+        self._puback = bytearray(b"\x40\x02\0\0")  # PUBACK packet, the pid is filled in
+        self.acked_pid = 0  # Packet id of the last PUBACK received
+        self.suback_rc = None  # Return code of the last SUBACK received
+        self.skipped = 0  # Number of packets skipped because too large
+        self.last_tx = 0  # ticks_ms() of the last packet sent
+        self.ping_sent = None  # ticks_ms() of the PINGREQ waiting for its PINGRESP
+        self.rtt_ms = None  # Round trip time of the last ping
+        self.ping_timeouts = 0  # Number of PINGRESPs that were overdue
 
-    def _send_str(self, s):
-        self.sock.write(struct.pack("!H", len(s)))
-        self.sock.write(s)
+    def _send(self, buf, n=-1):
+        """Write the first n bytes of buf, all with n=-1. Raises OSError after WRITE_TIMEOUT_MS."""
+        if n < 0:
+            n = len(buf)
+        sent = self.sock.write(buf, n) or 0  # None when nothing could be written
+        if sent == n:
+            return
+        deadline = time.ticks_add(time.ticks_ms(), self.WRITE_TIMEOUT_MS)
+        poller = select.poll()
+        poller.register(self.sock, select.POLLOUT)
+        while sent < n:
+            left = time.ticks_diff(deadline, time.ticks_ms())
+            if left <= 0:
+                raise OSError(errno.ETIMEDOUT)
+            poller.poll(left)
+            sent += self.sock.write(buf, sent, n - sent) or 0
 
-    def _recv_len(self):
-        n = 0
-        sh = 0
-        while 1:
-            b = self.sock.read(1)[0]
-            n |= (b & 0x7F) << sh
-            if not b & 0x80:
-                return n
-            sh += 7
+    def _send_str(self, s):
+        self._send(struct.pack("!H", len(s)))
+        self._send(s)
 
     def set_callback(self, f):
         self.cb = f
@@ -62,12 +108,21 @@ class MQTTClient:
         self.lw_retain = retain
 
     def connect(self, clean_session=True, timeout=None):
+        self._open(timeout)
+        self._rx_len = self._rx_skip = 0
+        self._send_connect(clean_session)
+        return self._connack(self.sock.read(4))
+
+    def _open(self, timeout):
         self.sock = socket.socket()
         self.sock.settimeout(timeout)
         addr = socket.getaddrinfo(self.server, self.port)[0][-1]
         self.sock.connect(addr)
         if self.ssl:
             self.sock = self.ssl.wrap_socket(self.sock, server_hostname=self.server)
+
+    def _send_connect(self, clean_session):
+        """Send the CONNECT packet."""
         premsg = bytearray(b"\x10\0\0\0\0\0")
         msg = bytearray(b"\x04MQTT\x04\x02\0\0")
 
@@ -92,8 +147,8 @@ class MQTTClient:
             i += 1
         premsg[i] = sz
 
-        self.sock.write(premsg, i + 2)
-        self.sock.write(msg)
+        self._send(premsg, i + 2)
+        self._send(msg)
         # print(hex(len(msg)), hexlify(msg, ":"))
         self._send_str(self.client_id)
         if self.lw_topic:
@@ -102,10 +157,15 @@ class MQTTClient:
         if self.user:
             self._send_str(self.user)
             self._send_str(self.pswd)
-        resp = self.sock.read(4)
-        assert resp[0] == 0x20 and resp[1] == 0x02
+
+    def _connack(self, resp):
+        """Check the CONNACK packet resp and complete the connection. Returns the session present flag."""
+        if len(resp) != 4 or resp[0] != 0x20 or resp[1] != 0x02:
+            raise MQTTException("bad CONNACK")
         if resp[3] != 0:
             raise MQTTException(resp[3])
+        self.last_tx = time.ticks_ms()
+        self.ping_sent = None
         if self.connect_cb is not None:
             self.connect_cb()
         return resp[2] & 1
@@ -114,11 +174,25 @@ class MQTTClient:
         self.connect_cb = f
 
     def disconnect(self):
-        self.sock.write(b"\xe0\0")
+        self._send(b"\xe0\0")
         self.sock.close()
 
     def ping(self):
-        self.sock.write(b"\xc0\0")
+        self._send(b"\xc0\0")
+        self.ping_sent = self.last_tx = time.ticks_ms()
+
+    def _keepalive(self):
+        """Send a PINGREQ when due, and raise OSError when its PINGRESP is overdue."""
+        if not self.keepalive:
+            return
+        now = time.ticks_ms()
+        if self.ping_sent is not None:
+            if time.ticks_diff(now, self.ping_sent) > self.PING_TIMEOUT_MS:
+                self.ping_sent = None
+                self.ping_timeouts += 1
+                raise OSError(errno.ETIMEDOUT)
+        elif time.ticks_diff(now, self.last_tx) >= self.keepalive * 750:
+            self.ping()
 
     def publish(self, topic, msg, retain=False, qos=0):
         pkt = bytearray(b"\x30\0\0\0")
@@ -134,24 +208,19 @@ class MQTTClient:
             i += 1
         pkt[i] = sz
         # print(hex(len(pkt)), hexlify(pkt, ":"))
-        self.sock.write(pkt, i + 1)
+        self._send(pkt, i + 1)
         self._send_str(topic)
         if qos > 0:
             self.pid += 1
             pid = self.pid
             struct.pack_into("!H", pkt, 0, pid)
-            self.sock.write(pkt, 2)
-        self.sock.write(msg)
+            self._send(pkt, 2)
+        self._send(msg)
+        self.last_tx = time.ticks_ms()
         if qos == 1:
-            while 1:
-                op = self.wait_msg()
-                if op == 0x40:
-                    sz = self.sock.read(1)
-                    assert sz == b"\x02"
-                    rcv_pid = self.sock.read(2)
-                    rcv_pid = rcv_pid[0] << 8 | rcv_pid[1]
-                    if pid == rcv_pid:
-                        return
+            # Incoming messages are handled while waiting for the PUBACK.
+            while self.acked_pid != pid:
+                self.wait_msg()
         elif qos == 2:
             assert 0
 
@@ -161,59 +230,130 @@ class MQTTClient:
         self.pid += 1
         struct.pack_into("!BH", pkt, 1, 2 + 2 + len(topic) + 1, self.pid)
         # print(hex(len(pkt)), hexlify(pkt, ":"))
-        self.sock.write(pkt)
+        self._send(pkt)
         self._send_str(topic)
-        self.sock.write(qos.to_bytes(1, "little"))
-        while 1:
-            op = self.wait_msg()
-            if op == 0x90:
-                resp = self.sock.read(4)
-                # print(resp)
-                assert resp[1] == pkt[2] and resp[2] == pkt[3]
-                if resp[3] == 0x80:
-                    raise MQTTException(resp[3])
-                return
+        self._send(qos.to_bytes(1, "little"))
+        self.last_tx = time.ticks_ms()
+        # The SUBACK is handled when it arrives, its return code is kept in suback_rc. When the
+        # broker refused the subscription, check_msg() raises MQTTException.
+        self.suback_rc = None
+
+    def _recv(self, blocking):
+        """Read what is available into the receive buffer. Returns False if nothing was read."""
+        self.sock.setblocking(blocking)
+        if self._rx_len == self.RX_SIZE:
+            return False
+        # Only a partly received packet needs a view of the rest of the buffer, so polling an
+        # empty buffer allocates nothing.
+        n = self.sock.readinto(self._rxmv[self._rx_len :] if self._rx_len else self._rxmv)
+        if n is None:
+            return False
+        if n == 0:
+            raise OSError(-1)
+        self._rx_len += n
+        return True
+
+    def _consume(self, n):
+        """
+        Remove n bytes from the start of the receive buffer. Moving the bytes behind them takes two
+        memoryview slices per chunk of n bytes.
+        """
+        left = self._rx_len - n
+        # Copy in chunks of at most n bytes, so the source and destination never overlap.
+        i = 0
+        while i < left:
+            c = min(n, left - i)
+            self._rxmv[i : i + c] = self._rxmv[n + i : n + i + c]
+            i += c
+        self._rx_len = left
+
+    def _parse(self):
+        """
+        Process the first complete packet in the receive buffer. Returns its type, 0 when the last
+        part of a skipped packet was removed, or None if no complete packet is buffered.
+        """
+        rx = self._rx
+        if not self._rx_skip:
+            # Fixed header: type and remaining length
+            sz = 0
+            i = 1
+            while True:
+                if i >= self._rx_len:
+                    return None
+                b = rx[i]
+                sz |= (b & 0x7F) << (7 * (i - 1))
+                i += 1
+                if not b & 0x80:
+                    break
+            end = i + sz
+            if end <= self.RX_SIZE:
+                if end > self._rx_len:
+                    return None
+                op = self._process(rx[0], i, end)
+                self._consume(end)
+                if op == 0x90 and self.suback_rc == 0x80:
+                    # Raised after the packet was removed, so it is not processed again.
+                    raise MQTTException("subscription refused")
+                return op
+            self.skipped += 1
+            self._rx_skip = end
+        n = min(self._rx_skip, self._rx_len)
+        self._rx_skip -= n
+        self._consume(n)
+        return None if self._rx_skip else 0
+
+    def _process(self, op, i, end):
+        """Process the packet of type op with the variable header and payload in _rx[i:end]."""
+        rx = self._rx
+        if op & 0xF0 == 0x30:  # PUBLISH
+            topic_len = rx[i] << 8 | rx[i + 1]
+            i += 2
+            topic = self._rxmv[i : i + topic_len]
+            i += topic_len
+            if op & 6:
+                pid = rx[i] << 8 | rx[i + 1]
+                i += 2
+            self.cb(topic, self._rxmv[i:end])
+            if op & 6 == 2:
+                struct.pack_into("!H", self._puback, 2, pid)
+                self._send(self._puback)
+            elif op & 6 == 4:
+                assert 0
+        elif op == 0x40:  # PUBACK
+            self._puback_received(rx[i] << 8 | rx[i + 1])
+        elif op == 0x90:  # SUBACK
+            self.suback_rc = rx[end - 1]
+        elif op == 0xD0:  # PINGRESP
+            if self.ping_sent is not None:
+                self.rtt_ms = time.ticks_diff(time.ticks_ms(), self.ping_sent)
+                self.ping_sent = None
+        return op
+
+    def _puback_received(self, pid):
+        self.acked_pid = pid
 
     # Wait for a single incoming MQTT message and process it.
     # Subscribed messages are delivered to a callback previously
     # set by .set_callback() method. Other (internal) MQTT
     # messages processed internally.
     def wait_msg(self):
-        res = self.sock.read(1)
-        self.sock.setblocking(True)
-        if res is None:
-            return None
-        if res == b"":
-            raise OSError(-1)
-        if res == b"\xd0":  # PINGRESP
-            sz = self.sock.read(1)[0]
-            assert sz == 0
-            return None
-        op = res[0]
-        if op & 0xF0 != 0x30:
-            return op
-        sz = self._recv_len()
-        topic_len = self.sock.read(2)
-        topic_len = (topic_len[0] << 8) | topic_len[1]
-        topic = self.sock.read(topic_len)
-        sz -= topic_len + 2
-        if op & 6:
-            pid = self.sock.read(2)
-            pid = pid[0] << 8 | pid[1]
-            sz -= 2
-        msg = self.sock.read(sz)
-        self.cb(topic, msg)
-        if op & 6 == 2:
-            pkt = bytearray(b"\x40\x02\0\0")
-            struct.pack_into("!H", pkt, 2, pid)
-            self.sock.write(pkt)
-        elif op & 6 == 4:
-            assert 0
-        return op
+        while 1:
+            if self._rx_len:
+                op = self._parse()
+                if op is not None:
+                    return op
+            self._recv(True)
 
-    # Checks whether a pending message from server is available.
-    # If not, returns immediately with None. Otherwise, does
-    # the same processing as wait_msg.
+    # Processes all complete packets that are available, without blocking, and keeps the
+    # connection alive. Returns the type of the last packet processed, or None if none.
     def check_msg(self):
-        self.sock.setblocking(False)
-        return self.wait_msg()
+        res = None
+        self._recv(False)
+        while self._rx_len:
+            op = self._parse()
+            if op is not None:
+                res = op
+            elif not self._recv(False):
+                break  # The rest of the packet arrives later
+        self._keepalive()
+        return res
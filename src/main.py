@@ -10,14 +10,24 @@ Functions:
 - start_initial_effect(): Starts the initial effect for the application.
 - init_settings_and_logging(): Initializes settings and logging.
 - startup(): Initializes the device and sets up LED and effects.
-- start_cloud(): Connects to WiFi and MQTT, and syncs time with NTP server.
-- main(print_help=True, enable_cloud=True): Main function to run the device.
-- allow_repl(): Allows REPL access by sleeping for 5 seconds.
+- start_cloud(): Starts connecting to WiFi without waiting.
+- cloud_poll(idle=None): Advances the WiFi connection, then connects MQTT and syncs time with NTP server.
+- cloud_poll_async(): The asyncio variant of cloud_poll(), awaits between the NTP requests.
+- mqtt_brightness_handler(topic, msg): Handler for the /brightness MQTT sub topic.
+- boot_report(): Return a dict with the durations of the boot phases in ms.
+- main(print_help=True, enable_cloud=True, use_async=None, repl_wait=False): Main function to run the device.
+- main_async(enable_cloud=True): Run the device as asyncio tasks.
+- allow_repl(idle=None): Allows REPL access by waiting for 5 seconds.
+
+At boot the initial effect is lit first. Connecting to WiFi, MQTT and NTP happens after that, from
+the main loop, while the effect keeps running. The durations of the boot phases are published on the /boot sub topic
+when the MQTT connection is up.
 """
 
 import gc
+import json
 from random import choice
-from time import sleep, ticks_diff, ticks_ms
+from time import sleep, sleep_ms, ticks_add, ticks_diff, ticks_ms
 
 import machine
 import micropython
@@ -26,16 +36,31 @@ import pixellib
 import senselogging as logging
 import settings
 
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+
 from connectivity import (
+    WIFI_AP,
+    WIFI_STA,
     is_wifi_connected,
     mqtt_connect,
+    mqtt_connected,
     mqtt_poll,
+    mqtt_publish,
     mqtt_register_callback,
+    mqtt_stats,
     ntp_sync_time,
-    wifi_connect,
+    wifi_poll,
+    wifi_start,
+    wifi_stats,
 )
 from effects import (
     effect_loop,
+    effect_loop_async,
+    effect_stats,
+    effect_time_to_next,
     full_help,
     get_effect_json,
     get_effects,
@@ -45,6 +70,12 @@ from effects import (
 )
 
 GC_INTERVAL = 30000  # 30 seconds in ms between garbage collection runs
+IDLE_SLICE_MS = 10  # Max time in ms to sleep between frames before polling MQTT again
+MQTT_POLL_MS = 20  # Time in ms between MQTT polls in async mode
+STATUS_INTERVAL = 60000  # Time in ms between status reports
+CLOUD_POLL_MS = 100  # Time in ms between WiFi connection polls
+NTP_TRIES = 3  # Number of NTP requests in async mode before giving up
+NTP_RETRY_MS = 1000  # Time in ms between NTP requests in async mode
 
 # Default settings, good for Xiao ESP32S3 with corresponding MicroPython firmware
 # Override these in .env file if needed.
@@ -53,6 +84,38 @@ ROWS = 3  # override with pix_rows setting
 PIXEL_PIN = 1  # override with pix_pin setting
 SDA_PIN = 0  # override with sda_pin setting
 SCL_PIN = 1  # override with scl_pin setting
+BRIGHTNESS = 1.0  # override with brightness setting
+GAMMA = 1.0  # override with gamma setting
+FRAME_POLICY = "drop"  # override with frame_policy setting
+
+_matrix = None  # The NeoPixMatrix the effects render on
+_boot_report = {}  # Boot phase -> duration in ms, see boot_report()
+_cloud_up = False  # True when MQTT and NTP were started on the current WiFi connection
+_cloud_start = 0  # ticks_ms() of start_cloud()
+_mqtt_start = None  # ticks_ms() of the first MQTT connect, until the client is connected
+_last_cloud_poll = 0  # ticks_ms() of the last cloud_poll() that did something
+
+
+def _mem_free():
+    """Return the free heap in bytes, or -1 if unknown, as gc.mem_free() is MicroPython only."""
+    return gc.mem_free() if hasattr(gc, "mem_free") else -1
+
+
+def _boot_phase(phase, start_ms):
+    """Record the duration of a boot phase that started at start_ms, return the current time."""
+    now = ticks_ms()
+    _boot_report[phase] = ticks_diff(now, start_ms)
+    return now
+
+
+def boot_report():
+    """
+    Return a dict with the durations in ms of the boot phases: settings, effects (initialization
+    of the effects), first_frame (start of the initial effect), and wifi, mqtt and ntp when the cloud
+    is enabled. mqtt runs from the WiFi connection until the MQTT client is connected, so it includes
+    the broker's CONNACK. first_light is the time in ms from reset to the first frame.
+    """
+    return _boot_report
 
 
 def start_initial_effect():
@@ -109,11 +172,16 @@ def startup():
        - Retrieving the pixel pin, columns, and rows from the settings or using default values.
        - Initializing the NeoPixel object with the specified pin and total number of pixels.
        - Creating a NeoPixMatrix object with the initialized NeoPixel object, columns, and rows.
-    5. Initializes the effects using the `init_effects(matrix)` function.
+       - Setting the brightness and gamma of the matrix from the settings.
+    5. Initializes the effects using the `init_effects(matrix)` function, and reports the time
+       this took and the free heap after startup.
     """
+    global _matrix
 
     micropython.alloc_emergency_exception_buf(100)
+    start_ms = ticks_ms()
     init_settings_and_logging()
+    start_ms = _boot_phase("settings", start_ms)
     logging.info("Starting Xmas Tree Lights Controller.")
 
     # Setup LED & effects stuff
@@ -121,53 +189,209 @@ def startup():
     pix_columns = int(settings.settings_get("pix_columns", COLS))
     pix_rows = int(settings.settings_get("pix_rows", ROWS))
     pixels = neopixel.NeoPixel(machine.Pin(pix_pin), pix_columns * pix_rows)
-    matrix = pixellib.NeoPixMatrix(pixels, pix_columns, pix_rows)
-    init_effects(matrix)
+    _matrix = pixellib.NeoPixMatrix(pixels, pix_columns, pix_rows)
+    _matrix.set_brightness(
+        float(settings.settings_get("brightness", BRIGHTNESS)),
+        float(settings.settings_get("gamma", GAMMA)),
+    )
+    lazy = settings.settings_get("lazy_effects", "1").strip() == "1"
+    start_ms = ticks_ms()
+    init_effects(
+        _matrix,
+        frame_policy=settings.settings_get("frame_policy", FRAME_POLICY),
+        lazy=lazy,
+    )
+    _boot_phase("effects", start_ms)
+    gc.collect()
+    logging.info(
+        "Effects initialized in %d ms with the lazy registry %s, %d bytes free.",
+        _boot_report["effects"],
+        "on" if lazy else "off",
+        _mem_free(),
+    )
 
 
 def start_cloud():
     """
-    Connect to WiFi and MQTT and attempt to sync time with NTP server in the cloud.
+    Start connecting to WiFi in the cloud without waiting. cloud_poll() completes the connection.
+    We can re-use an existing STA connection, but will reconnect if not connected or AP.
+    """
+    global _cloud_up, _cloud_start
+
+    logging.info("Connecting to WiFi and MQTT")
+    _cloud_up = False
+    _cloud_start = ticks_ms()
+    mqtt_register_callback("effect", mqtt_effect_handler)
+    mqtt_register_callback("effect/bin", mqtt_effect_handler)
+    mqtt_register_callback("brightness", mqtt_brightness_handler)
+    wifi_start(reconnect=is_wifi_connected() != "STA")
 
-    This function attempts to connect to a WiFi network and then to an MQTT broker.
-    If the WiFi connection is successful, it proceeds to connect to the MQTT broker
-    and synchronizes the time using NTP.
 
-    Raises:
-        ConnectionError: If the WiFi connection fails.
+def _cloud_step():
     """
-    logging.info("Connecting to WiFi and MQTT")
-    # We can re-use an existing STA connection, but will reconnect if not connected or AP.
-    reconnect = is_wifi_connected() != "STA"
-    if wifi_connect(reconnect=reconnect) == "STA":
-        mqtt_register_callback("effect", mqtt_effect_handler)
-        mqtt_connect()
-        ntp_sync_time()
-    else:
-        logging.info(
-            "No WiFi network connection available, AP mode only. No MQTT and NTP."
-        )
+    Advance the WiFi connection for cloud_poll() and cloud_poll_async(). Return the ticks_ms() of
+    this poll when the WiFi station connection just came up and MQTT and NTP should be started,
+    else None.
+    """
+    global _cloud_up, _last_cloud_poll
+
+    now = ticks_ms()
+    if ticks_diff(now, _last_cloud_poll) < CLOUD_POLL_MS:
+        return None
+    _last_cloud_poll = now
+    state = wifi_poll()
+    if state != WIFI_STA:
+        _cloud_up = False
+        if state == WIFI_AP and "wifi" not in _boot_report:
+            _boot_report["wifi"] = ticks_diff(now, _cloud_start)
+            logging.info("No WiFi network connection available, AP mode only. No MQTT and NTP.")
+            _publish_boot_report(False)
+        return None
+    if _cloud_up:
+        return None
+    _cloud_up = True
+    return now
+
+
+def _cloud_report(now, mqtt_ms):
+    """
+    Record the durations of the first WiFi and NTP connections in the boot report. The MQTT
+    connection completes later, in mqtt_poll(), and is recorded by _mqtt_boot_phase().
+    """
+    global _mqtt_start
+
+    if "wifi" not in _boot_report:
+        _boot_report["wifi"] = ticks_diff(now, _cloud_start)
+        _boot_phase("ntp", mqtt_ms)
+        _mqtt_start = now
+
+
+def _mqtt_boot_phase():
+    """
+    Record the mqtt boot phase and publish the boot report when the first MQTT connection is up.
+    Call this after mqtt_poll(), which completes the connection.
+    """
+    global _mqtt_start
+
+    if _mqtt_start is not None and mqtt_connected():
+        _boot_phase("mqtt", _mqtt_start)
+        _mqtt_start = None
+        _publish_boot_report(True)
+
+
+def cloud_poll(idle=None):
+    """
+    Advance the WiFi connection, call this regularly after start_cloud(). When the WiFi station
+    connection is up, connect to MQTT and sync the time with NTP. The MQTT client reconnects by
+    itself from mqtt_poll() when the MQTT connection is lost while WiFi is up. The durations of the
+    first connections are recorded in the boot report.
+
+    Args:
+        idle (function, optional): Called with the time in ms to wait while syncing the time with
+                                   NTP, e.g. to keep the effect running. Defaults to sleeping.
+    """
+    now = _cloud_step()
+    if now is None:
+        return
+    mqtt_connect()
+    mqtt_ms = ticks_ms()
+    ntp_sync_time(idle=idle)
+    _cloud_report(now, mqtt_ms)
+
+
+async def cloud_poll_async():
+    """
+    The asyncio variant of cloud_poll(). Between the NTP requests it awaits instead of waiting
+    in an idle function, so the other tasks keep running. The DNS lookup of the MQTT broker and
+    each NTP request still block, see connectivity.py.
+    """
+    now = _cloud_step()
+    if now is None:
+        return
+    mqtt_connect()
+    mqtt_ms = ticks_ms()
+    for i in range(NTP_TRIES):
+        if ntp_sync_time(tries=1):
+            break
+        if i < NTP_TRIES - 1:
+            await asyncio.sleep(NTP_RETRY_MS / 1000)
+    _cloud_report(now, mqtt_ms)
+
+
+def mqtt_brightness_handler(topic, msg):
+    """
+    Handler for the /brightness MQTT sub topic.
+
+    The message holds the brightness from 0.0 to 1.0, optionally followed by the gamma,
+    e.g. "0.4" or "0.4 2.2".
+    """
+    try:
+        values = bytes(msg).decode().split()
+        gamma = float(values[1]) if len(values) > 1 else _matrix.gamma
+        _matrix.set_brightness(float(values[0]), gamma)
+        logging.info("Brightness set to %s, gamma %s.", _matrix.brightness, _matrix.gamma)
+    except Exception as e:
+        logging.exc(e, "Invalid brightness: %s", msg)
 
 
-def main(print_help=True, enable_cloud=True):
-    """Main function to run the device."""
+def _run_frames(ms):
+    """Run the effect for ms milliseconds, used to keep the lights going while connecting."""
+    end_ms = ticks_add(ticks_ms(), ms)
+    while True:
+        effect_loop()
+        left_ms = ticks_diff(end_ms, ticks_ms())
+        if left_ms <= 0:
+            return
+        sleep_ms(max(1, min(effect_time_to_next(), left_ms)))
+
+
+def _publish_boot_report(publish):
+    """Log the boot report, and with publish set publish it on the /boot sub topic."""
+    report = json.dumps(_boot_report)
+    logging.info("Boot report (ms): %s", report)
+    if publish:
+        try:
+            mqtt_publish("boot", report)
+        except Exception as e:
+            logging.exc(e, "Could not publish the boot report.")
+
+
+def main(print_help=True, enable_cloud=True, use_async=None, repl_wait=False):
+    """
+    Main function to run the device. The initial effect is started first, then the device
+    connects to the cloud while the effect keeps running.
+
+    Args:
+        print_help (bool): Print the help of all effects after startup. Defaults to True.
+        enable_cloud (bool): Connect to WiFi, MQTT and NTP. Defaults to True.
+        use_async (bool): Run as asyncio tasks. Defaults to the use_async setting, or False.
+        repl_wait (bool): Allow entering the REPL after the initial effect started. Defaults to False.
+    """
+    if use_async is None:
+        settings.settings_load()
+        use_async = settings.settings_get("use_async", "0").strip() in ("1", "true", "True")
     startup()
 
-    if enable_cloud:
-        start_cloud()
+    start_ms = ticks_ms()
     start_initial_effect()
+    _boot_phase("first_frame", start_ms)
+    _boot_report["first_light"] = ticks_ms()
 
     if print_help:
         print("\n" + full_help())
+    if repl_wait:
+        allow_repl(_run_frames)
+
+    if enable_cloud:
+        start_cloud()
+    else:
+        _publish_boot_report(False)
 
-    last_gc = ticks_ms()
     try:
-        while True:
-            effect_loop()  # Run the effect's next step
-            mqtt_poll()  # Poll for incoming MQTT messages
-            if ticks_diff(ticks_ms(), last_gc) > GC_INTERVAL:
-                gc.collect()
-                last_gc = ticks_ms()
+        if use_async:
+            asyncio.run(main_async(enable_cloud))
+        else:
+            _main_loop(enable_cloud)
 
     except Exception as e:
         logging.exc(e, "An unhandled exception occurred.")
@@ -180,18 +404,109 @@ def main(print_help=True, enable_cloud=True):
             pass
 
 
-def allow_repl():
-    """Allow REPL access by sleeping for 5 seconds."""
+def _main_loop(enable_cloud=True):
+    """
+    Run the effects, cloud connection, MQTT polling, status publishing and garbage collection in a
+    single loop.
+    """
+    last_gc = last_status = ticks_ms()
+    while True:
+        effect_loop()  # Run the effect's next step
+        if enable_cloud:
+            cloud_poll(_run_frames)  # Advance the WiFi, MQTT and NTP connections
+        mqtt_poll()  # Poll for incoming MQTT messages
+        _mqtt_boot_phase()
+        if ticks_diff(ticks_ms(), last_gc) > GC_INTERVAL:
+            gc.collect()
+            last_gc = ticks_ms()
+            logging.debug("Frame stats: %s", effect_stats())
+        if enable_cloud and ticks_diff(ticks_ms(), last_status) > STATUS_INTERVAL:
+            _publish_status()
+            last_status = ticks_ms()
+        # Idle until the next frame is due, waking up regularly to poll MQTT.
+        idle_ms = effect_time_to_next()
+        if idle_ms > 0:
+            sleep_ms(min(idle_ms, IDLE_SLICE_MS))
+
+
+async def _mqtt_task():
+    """Poll for incoming MQTT messages."""
+    while True:
+        mqtt_poll()
+        _mqtt_boot_phase()
+        await asyncio.sleep(MQTT_POLL_MS / 1000)
+
+
+def _publish_status():
+    """Publish the frame statistics and the WiFi and MQTT metrics on the /status sub topic."""
+    if mqtt_connected():
+        try:
+            status = effect_stats()
+            status["wifi"] = wifi_stats()
+            status["mqtt"] = mqtt_stats()
+            mqtt_publish("status", json.dumps(status))
+        except Exception as e:
+            logging.exc(e, "Could not publish status.")
+
+
+async def _status_task():
+    """Publish the status every STATUS_INTERVAL."""
+    while True:
+        await asyncio.sleep(STATUS_INTERVAL / 1000)
+        _publish_status()
+
+
+async def _gc_task():
+    """Run the garbage collector regularly."""
+    while True:
+        await asyncio.sleep(GC_INTERVAL / 1000)
+        gc.collect()
+        logging.debug("Frame stats: %s", effect_stats())
+
+
+async def _cloud_task():
+    """Connect to WiFi and MQTT, and reconnect when a connection was lost."""
+    while True:
+        await cloud_poll_async()
+        await asyncio.sleep(CLOUD_POLL_MS / 1000)
+
+
+async def main_async(enable_cloud=True):
+    """
+    Run the device as asyncio tasks: effect rendering, MQTT polling, status publishing,
+    garbage collection and, with enable_cloud, connection supervision.
+    Works with both MicroPython asyncio and CPython asyncio.
+    """
+    tasks = [
+        asyncio.create_task(effect_loop_async()),
+        asyncio.create_task(_mqtt_task()),
+        asyncio.create_task(_status_task()),
+        asyncio.create_task(_gc_task()),
+    ]
+    if enable_cloud:
+        tasks.append(asyncio.create_task(_cloud_task()))
+    await asyncio.gather(*tasks)
+
+
+def allow_repl(idle=None):
+    """
+    Allow REPL access by waiting for 5 seconds.
+
+    Args:
+        idle (function, optional): Called with the time in ms to wait instead of sleeping.
+    """
     print(
         "You have 5 seconds to press Ctrl+C to stop the program and enter the REPL.",
         end="",
     )
     for i in range(10):
         print(".", end="")
-        sleep(0.5)
+        if idle is None:
+            sleep(0.5)
+        else:
+            idle(500)
     print()
 
 
 if __name__ == "__main__":
-    allow_repl()
-    main()
+    main(repl_wait=True)
@@ -0,0 +1,61 @@
+"""
+bench_boot.py - Boot benchmark of the app imported from source and from the precompiled bundle.
+
+Build the bundle first (see lib/mpybundle.py), upload it, then run on the board from the src directory:
+    mpremote run tests/bench_boot.py
+
+For both paths it imports main, runs startup() and renders the first frame of the initial effect,
+and reports the time to the first frame and the peak heap. The garbage collector is disabled during
+a boot, so the peak heap is all memory allocated during the boot, including the compiler's garbage.
+The retained heap is what is left after a collection. Each path is booted ROUNDS times and the last
+round is reported, so the effect manifests are written before the measurement.
+"""
+
+import gc
+import sys
+from time import ticks_diff, ticks_ms
+
+sys.path.append("lib")
+
+import mpybundle
+
+ROUNDS = 2
+
+_preloaded = set(sys.modules)
+
+
+def boot():
+    """Import and start the app, return the ms to the first frame and the peak and retained heap."""
+    for name in [m for m in sys.modules if m not in _preloaded]:
+        del sys.modules[name]
+    gc.collect()
+    base = gc.mem_alloc()
+    gc.disable()
+    start = ticks_ms()
+    try:
+        import main
+
+        main.startup()
+        main.start_initial_effect()
+        ms = ticks_diff(ticks_ms(), start)
+        peak = gc.mem_alloc() - base
+    finally:
+        gc.enable()
+    gc.collect()
+    return ms, peak, gc.mem_alloc() - base
+
+
+def bench(label, use_bundle):
+    mpybundle.deactivate()
+    if use_bundle and not mpybundle.activate():
+        print(f"{label:8} skipped")
+        return
+    for _ in range(ROUNDS):
+        ms, peak, retained = boot()
+    print(f"{label:8} first frame {ms:6} ms, peak heap {peak:7} bytes, retained {retained:7} bytes")
+
+
+print(f"Boot benchmark on {sys.implementation.name}")
+bench("source", False)
+bench("bundle", True)
+mpybundle.deactivate()
@@ -0,0 +1,183 @@
+"""
+bench_gfx.py - Micro-benchmark of the per-pixel call overhead of the GFX primitives.
+
+Runs on the host (CPython) and on MicroPython (unix port or a board) from the src directory:
+    python tests/bench_gfx.py
+    micropython tests/bench_gfx.py
+
+It times a pixel call that passes on *args/**kwargs with color= (as GFX used to do for every
+plotted point) against a call with a positional color (as GFX does now). Then it times the line
+and fill_circle primitives of GFX against GFXBefore, a copy of them from before the color was
+bound once per primitive, both drawing with the same pixel function.
+"""
+
+import sys
+
+sys.path.append("lib")
+
+from gfx import GFX
+
+try:
+    from time import ticks_diff, ticks_us
+except ImportError:
+    from time import perf_counter
+
+    def ticks_us():
+        return int(perf_counter() * 1000000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+
+N = 20000
+COLOR = (10, 20, 30)
+
+
+def pixel(x, y, color=(0, 0, 0)):
+    pass
+
+
+class GFXBefore(GFX):
+    # The primitives as they were, forwarding *args and **kwargs to every pixel.
+
+    def _slow_vline(self, x0, y0, height, *args, **kwargs):
+        # Slow implementation of a vertical line using pixel drawing.
+        # This is used as the default vertical line if no faster override
+        # is provided.  The span is clipped to the drawing area first.
+        if x0 < 0 or x0 >= self.width:
+            return
+        if y0 < 0:
+            height += y0
+            y0 = 0
+        height = min(height, self.height - y0)
+        for y in range(y0, y0 + height):
+            self._pixel(x0, y, *args, **kwargs)
+
+    def line(self, x0, y0, x1, y1, *args, **kwargs):
+        # Line drawing function.  Will draw a single pixel wide line starting at
+        # x0, y0 and ending at x1, y1.
+        # The line is clipped to the drawing area before it is drawn, such that
+        # exactly the pixels of the unclipped line that are visible get drawn.
+        steep = abs(y1 - y0) > abs(x1 - x0)
+        if steep:
+            x0, y0 = y0, x0
+            x1, y1 = y1, x1
+            x_size, y_size = self.height, self.width
+        else:
+            x_size, y_size = self.width, self.height
+        if x0 > x1:
+            x0, x1 = x1, x0
+            y0, y1 = y1, y0
+        dx = x1 - x0
+        dy = abs(y1 - y0)
+        err = dx // 2
+        ystep = 0
+        if y0 < y1:
+            ystep = 1
+        else:
+            ystep = -1
+        # Step k of the line draws x = x0 + k, y = y0 + ystep * m, where
+        # m = -((err - k * dy) // dx) is the number of y steps taken so far.
+        # Find the range of k for which both x and y are within the drawing area.
+        k_lo = max(0, -x0)
+        k_hi = min(dx, x_size - 1 - x0)
+        if ystep > 0:
+            m_lo, m_hi = -y0, y_size - 1 - y0
+        else:
+            m_lo, m_hi = y0 - y_size + 1, y0
+        if dy == 0:
+            if m_lo > 0 or m_hi < 0:
+                return
+        else:
+            if m_lo > 0:
+                k_lo = max(k_lo, (err - (1 - m_lo) * dx) // dy + 1)
+            k_hi = min(k_hi, (err + m_hi * dx) // dy)
+        if k_lo > k_hi:
+            return
+        # Start the walk at step k_lo.
+        if k_lo:
+            m = -((err - k_lo * dy) // dx)
+            err += m * dx - k_lo * dy
+            y0 += ystep * m
+            x0 += k_lo
+        x1 = x0 + k_hi - k_lo
+        while x0 <= x1:
+            if steep:
+                self._pixel(y0, x0, *args, **kwargs)
+            else:
+                self._pixel(x0, y0, *args, **kwargs)
+            err -= dy
+            if err < 0:
+                y0 += ystep
+                err += dx
+            x0 += 1
+
+    def fill_circle(self, x0, y0, radius, *args, **kwargs):
+        # Filled circle drawing function.  Will draw a filled circule with
+        # center at x0, y0 and the specified radius.
+        # Columns outside the drawing area are skipped, the vertical spans
+        # are clipped by vline.
+        size = 2 * radius + 1
+        if self._outside(x0 - radius, y0 - radius, size, size):
+            return
+        width = self.width
+        vline = self.vline
+        if 0 <= x0 < width:
+            vline(x0, y0 - radius, size, *args, **kwargs)
+        f = 1 - radius
+        ddF_x = 1
+        ddF_y = -2 * radius
+        x = 0
+        y = radius
+        while x < y:
+            if f >= 0:
+                y -= 1
+                ddF_y += 2
+                f += ddF_y
+            x += 1
+            ddF_x += 2
+            f += ddF_x
+            if 0 <= x0 + x < width:
+                vline(x0 + x, y0 - y, 2 * y + 1, *args, **kwargs)
+            if 0 <= x0 + y < width:
+                vline(x0 + y, y0 - x, 2 * x + 1, *args, **kwargs)
+            if 0 <= x0 - x < width:
+                vline(x0 - x, y0 - y, 2 * y + 1, *args, **kwargs)
+            if 0 <= x0 - y < width:
+                vline(x0 - y, y0 - x, 2 * x + 1, *args, **kwargs)
+
+
+def timed(label, f, n):
+    start = ticks_us()
+    f()
+    us = ticks_diff(ticks_us(), start)
+    print(f"{label:40} {us * 1000 // n:8} ns/pixel")
+
+
+def pixel_kwargs(*args, **kwargs):
+    for i in range(N):
+        pixel(i, i, *args, **kwargs)
+
+
+def pixel_positional():
+    for i in range(N):
+        pixel(i, i, COLOR)
+
+
+def draw_lines(g):
+    for _ in range(N // 64):
+        g.line(0, 0, 63, 63, color=COLOR)
+
+
+def draw_circles(g):
+    for _ in range(N // 256):
+        g.fill_circle(32, 32, 9, color=COLOR)
+
+
+print(f"GFX per-pixel call overhead on {sys.implementation.name}")
+timed("pixel(x, y, **kwargs) (before)", lambda: pixel_kwargs(color=COLOR), N)
+timed("pixel(x, y, color) (after)", pixel_positional, N)
+timed("line(..., color=) (before)", lambda: draw_lines(GFXBefore(64, 64, pixel)), N)
+timed("line(..., color=) (after)", lambda: draw_lines(GFX(64, 64, pixel)), N)
+timed("fill_circle(..., color=) (before)", lambda: draw_circles(GFXBefore(64, 64, pixel)), N)
+timed("fill_circle(..., color=) (after)", lambda: draw_circles(GFX(64, 64, pixel)), N)
@@ -0,0 +1,213 @@
+"""
+test_async.py - Host test of main_async(): runs the asyncio tasks for a bounded time and checks
+the frame rate and the MQTT poll rate, first without the cloud, then with a WiFi connection whose
+NTP requests keep failing, so cloud_poll_async() is waiting between its retries.
+
+Runs on the host from the src directory, with CPython or the MicroPython unix port:
+    python3 tests/test_async.py
+    micropython tests/test_async.py
+The board modules missing on the host (machine, neopixel, network, ...) are simulated. On the board
+the real modules are used: mpremote run tests/test_async.py
+"""
+
+import sys
+
+sys.path.insert(0, "")  # The src directory, the current directory when run as documented
+sys.path.append("lib")
+
+RUN_MS = 3000  # Time in ms to run the tasks
+WAIT_MS = 20  # Frame period in ms of the test effect
+MIN_SHARE = 0.8  # Share of the expected frames and MQTT polls that must happen
+
+
+def _module(name, **attrs):
+    """Return the module name, creating it if missing, with attrs added where missing."""
+    try:
+        mod = __import__(name)
+    except ImportError:
+        mod = type(sys)(name)
+        sys.modules[name] = mod
+    for attr, value in attrs.items():
+        if not hasattr(mod, attr):
+            setattr(mod, attr, value)
+    return mod
+
+
+class _Pin:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def on(self):
+        pass
+
+    def off(self):
+        pass
+
+
+class _I2C:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def scan(self):
+        return []
+
+
+class _RTC:
+    def datetime(self, *args):
+        pass
+
+
+class _NeoPixel:
+    def __init__(self, pin, n, bpp=3, timing=1):
+        self.pin = pin
+        self.n = n
+        self.bpp = bpp
+        self.buf = bytearray(n * bpp)
+
+    def __len__(self):
+        return self.n
+
+    def __setitem__(self, i, v):
+        self.buf[i * self.bpp : (i + 1) * self.bpp] = bytes((v[1], v[0], v[2]))
+
+    def fill(self, v):
+        for i in range(self.n):
+            self[i] = v
+
+    def write(self):
+        pass
+
+
+class _WLAN:
+    def __init__(self, interface):
+        self._active = False
+
+    def active(self, value=None):
+        if value is None:
+            return self._active
+        self._active = value
+
+    def isconnected(self):
+        return False
+
+    def status(self, *args):
+        return 0
+
+    def config(self, *args, **kwargs):
+        pass
+
+    def connect(self, *args, **kwargs):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def ifconfig(self, *args):
+        return ("0.0.0.0",) * 4
+
+    def scan(self):
+        return []
+
+
+def _simulate_board():
+    """Add the MicroPython and board modules and functions missing on the host."""
+    import time
+
+    if not hasattr(time, "ticks_ms"):  # CPython
+        import builtins
+        import io
+
+        time.ticks_ms = lambda: time.monotonic_ns() // 1000000 & 0x3FFFFFFF
+        time.ticks_us = lambda: time.monotonic_ns() // 1000 & 0x3FFFFFFF
+        time.ticks_add = lambda t, delta: (t + delta) & 0x3FFFFFFF
+        time.ticks_diff = lambda a, b: ((a - b + 0x20000000) & 0x3FFFFFFF) - 0x20000000
+        time.sleep_ms = lambda ms: time.sleep(ms / 1000)
+        sys.modules["uio"] = io
+        sys.modules["utime"] = time
+        sys.print_exception = lambda e, f=None: print(repr(e), file=f)
+        builtins.ptr8 = lambda buf: buf
+    _module(
+        "micropython",
+        const=lambda x: x,
+        native=lambda f: f,
+        viper=lambda f: f,
+        alloc_emergency_exception_buf=lambda n: None,
+    )
+    _module(
+        "machine",
+        Pin=_Pin,
+        I2C=_I2C,
+        RTC=_RTC,
+        unique_id=lambda: b"\x01\x02\x03\x04",
+        reset=lambda: None,
+    )
+    _module("neopixel", NeoPixel=_NeoPixel)
+    _module("network", WLAN=_WLAN, STA_IF=0, AP_IF=1, AUTH_WPA_WPA2_PSK=3, STAT_CONNECTING=1001)
+    _module("ntptime", time=lambda: 0)
+
+
+def _run(main, enable_cloud):
+    """Run main_async() for RUN_MS, return the frames rendered and the MQTT polls."""
+    import asyncio
+    from effects import effect_stats
+
+    polls = [0]
+
+    def mqtt_poll():
+        polls[0] += 1
+
+    main.mqtt_poll = mqtt_poll
+    frames = effect_stats()["frames"]
+    try:
+        asyncio.run(asyncio.wait_for(main.main_async(enable_cloud), RUN_MS / 1000))
+    except asyncio.TimeoutError:
+        pass
+    return effect_stats()["frames"] - frames, polls[0]
+
+
+def _check(label, frames, polls, mqtt_poll_ms):
+    print("%s: %d frames, %d MQTT polls in %d ms" % (label, frames, polls, RUN_MS))
+    assert frames >= MIN_SHARE * RUN_MS / WAIT_MS, "frame rate too low"
+    assert polls >= MIN_SHARE * RUN_MS / mqtt_poll_ms, "MQTT poll rate too low"
+
+
+def test_async():
+    _simulate_board()
+    import time
+
+    import main
+    import settings
+    from effects import effect_by_name, start_effect
+
+    try:
+        open(settings.DEFAULT_FILE_PATH).close()
+    except OSError:
+        settings._loaded = True  # No dot.env on the host, run with the default settings
+
+    main.startup()
+    start_effect(effect_by_name("blink"), {"wait": WAIT_MS})
+    frames, polls = _run(main, False)
+    _check("no cloud", frames, polls, main.MQTT_POLL_MS)
+
+    # WiFi is up, NTP keeps failing: the tasks must keep running during the retries.
+    ntp_requests = [0]
+
+    def ntp_sync_time(idle=None, tries=3):
+        for i in range(tries):
+            ntp_requests[0] += 1
+            if i < tries - 1:
+                (idle or time.sleep_ms)(main.NTP_RETRY_MS)
+        return False
+
+    main.wifi_poll = lambda: main.WIFI_STA
+    main.mqtt_connect = lambda: None
+    main.ntp_sync_time = ntp_sync_time
+    main._publish_boot_report = lambda publish: None
+    frames, polls = _run(main, True)
+    _check("NTP retries", frames, polls, main.MQTT_POLL_MS)
+    assert ntp_requests[0] == main.NTP_TRIES, "NTP requests not retried"
+    print("test_async passed")
+
+
+if __name__ == "__main__":
+    test_async()
@@ -0,0 +1,57 @@
+"""
+test_bincmd.py - Test of the binary effect commands: pack_command() and bin2params() in effects.
+
+Runs on the board from the src directory:
+    mpremote run tests/test_bincmd.py
+"""
+
+import sys
+
+sys.path.insert(0, "")  # The src directory, the current directory when run as documented
+sys.path.append("lib")
+
+from effects import BIN_EFFECT_IDS, BIN_RESTART, BIN_RUNNING, BIN_VERSION, bin2params, pack_command
+from main import startup
+
+
+def expect_error(f, *args):
+    try:
+        f(*args)
+    except ValueError:
+        return
+    raise AssertionError("no error for %r" % (args,))
+
+
+def test_bincmd():
+    startup()
+    data = pack_command("blink", {"wait": 250, "color": "#ff8000", "style": "row", "other": 1})
+    assert data[:3] == bytes((BIN_VERSION, BIN_EFFECT_IDS["blink"], 0))
+    assert bin2params(data) == (
+        BIN_EFFECT_IDS["blink"],
+        {"wait": 250, "color": (255, 128, 0), "style": "row"},
+    )
+    assert bin2params(pack_command(None, {"ms": 0x12345, "update": False})) == (
+        BIN_RUNNING,
+        {"ms": 0x12345, "update": False},
+    )
+    assert bin2params(bytes((BIN_VERSION, 0, BIN_RESTART, 99, 1, 0))) == (0, {"update": False})
+
+    for params in ({"wait": -1}, {"wait": 0x100000000}, {"color": "nocolor"}, {"style": "x" * 256}):
+        expect_error(pack_command, "blink", params)
+    expect_error(pack_command, "noeffect", {})
+    for data in (
+        b"",
+        bytes((BIN_VERSION, 0)),  # Short header
+        bytes((BIN_VERSION + 1, 0, 0)),  # Unknown version
+        bytes((BIN_VERSION, 0, 0, 1, 2, 0)),  # Truncated parameter
+        bytes((BIN_VERSION, 0, 0, 1)),  # Truncated tag and length
+        bytes((BIN_VERSION, 0, 0, 2, 2, 0, 0)),  # Color of 2 bytes
+        bytes((BIN_VERSION, 0, 0, 1, 5, 0, 0, 0, 0, 1)),  # Number of 5 bytes
+        bytes((BIN_VERSION, 0, 0, 5, 1, 0xFF)),  # Invalid UTF-8
+    ):
+        expect_error(bin2params, data)
+    print("test_bincmd passed")
+
+
+if __name__ == "__main__":
+    test_bincmd()
@@ -0,0 +1,70 @@
+"""
+test_colors.py - Test of the color parser in colors.py and the wifi_stations parser in connectivity.py.
+
+Runs on the board from the src directory, as connectivity needs the network module:
+    mpremote run tests/test_colors.py
+"""
+
+import sys
+
+sys.path.insert(0, "")  # The src directory, the current directory when run as documented
+sys.path.append("lib")
+
+import colors
+from colors import parse_color
+
+
+def expect_error(color):
+    try:
+        parse_color(color)
+    except ValueError:
+        return
+    raise AssertionError("no error for %r" % (color,))
+
+
+def test_colors():
+    assert parse_color("(200,0,0)") == (200, 0, 0)
+    assert parse_color(" ( 200, 30 ,4 ) ") == (200, 30, 4)
+    assert parse_color("[1,2,3]") == parse_color("1,2,3") == (1, 2, 3)
+    assert parse_color("#C81E04") == (200, 30, 4)
+    assert parse_color("#f80") == (255, 136, 0)
+    assert parse_color("Warm White") == parse_color("warm_white") == colors.NAMED_COLORS["warmwhite"]
+    assert parse_color("hsv(0,100,100)") == (255, 0, 0)
+    assert parse_color("hsv(120, 100, 100)") == (0, 255, 0)
+    assert parse_color("hsv(240,100,50)") == (0, 0, 127)
+    assert parse_color("hsv(0,0,100)") == (255, 255, 255)
+    assert parse_color((1, 2, 3)) == parse_color([1, 2, 3]) == (1, 2, 3)
+    for bad in ("(256,0,0)", "(1,2)", "(1,2,3", "#12345", "#-1ffff", "#+1+1+1", "# 1ffff",
+                "hsv(361,0,0)", "nocolor", "", "__import__('os').remove('main.py')", (1, 2, 3, 4)):
+        expect_error(bad)
+
+    # Least recently used colors are dropped from the cache first.
+    colors._cache.clear()
+    colors._lru.clear()
+    for i in range(colors.CACHE_SIZE):
+        parse_color("(%d,0,0)" % i)
+    parse_color("(0,0,0)")  # Now the most recently used
+    parse_color("red")
+    assert len(colors._cache) == colors.CACHE_SIZE
+    assert "(0,0,0)" in colors._cache and "(1,0,0)" not in colors._cache
+    print("test_colors passed")
+
+
+def test_wifi_stations():
+    import connectivity
+
+    parse = connectivity._wifi_parse_stations
+    assert parse("[]") == []
+    assert parse('[("home", "pw1"), (\'office\', "p,w\\"2")]') == [("home", "pw1"), ("office", 'p,w"2')]
+    for bad in ('[("home")]', '[("home", pw)]', "__import__('os')"):
+        try:
+            parse(bad)
+        except ValueError:
+            continue
+        raise AssertionError("no error for %r" % bad)
+    print("test_wifi_stations passed")
+
+
+if __name__ == "__main__":
+    test_colors()
+    test_wifi_stations()
@@ -0,0 +1,48 @@
+"""
+test_frames.py - Test that NeoPixMatrix.write() skips a frame identical to the last one sent, and
+that effect_stats() reports the frames written and skipped.
+
+Runs on the host from the src directory, with the board simulation of test_async.py:
+    python3 tests/test_frames.py
+or on the board: mpremote run tests/test_frames.py
+"""
+
+import sys
+
+sys.path.insert(0, "")  # The src directory, the current directory when run as documented
+sys.path.append("lib")
+sys.path.append("tests")
+
+
+def test_frames():
+    try:
+        from test_async import _simulate_board
+
+        _simulate_board()
+    except ImportError:
+        pass  # On the board
+    import main
+    import settings
+    from effects import effect_stats
+
+    settings._loaded = True  # The default settings
+    main.startup()
+    m = main._matrix
+
+    m.fill((10, 20, 30))
+    m.write()
+    stats = effect_stats()
+    assert not m.write(), "identical frame written"
+    after = effect_stats()
+    assert after["frames_skipped"] == stats["frames_skipped"] + 1
+    assert after["frames_written"] == stats["frames_written"]
+
+    m.set_pix(0, 0, (1, 2, 3))
+    assert m.write(), "changed frame skipped"
+    assert effect_stats()["frames_written"] == stats["frames_written"] + 1
+    assert m.write(force=True), "forced frame skipped"
+    print("test_frames passed")
+
+
+if __name__ == "__main__":
+    test_frames()
@@ -0,0 +1,51 @@
+"""
+test_update.py - Test of live updates of the running effect: parameters the effect can change in
+place keep the effect object, other parameters restart the effect.
+
+Runs on the host from the src directory, with the board simulation of test_async.py:
+    python3 tests/test_update.py
+or on the board: mpremote run tests/test_update.py
+"""
+
+import sys
+
+sys.path.insert(0, "")  # The src directory, the current directory when run as documented
+sys.path.append("lib")
+sys.path.append("tests")
+
+
+def test_update():
+    try:
+        from test_async import _simulate_board
+
+        _simulate_board()
+    except ImportError:
+        pass  # On the board
+    import effects
+    import settings
+    from effects import start_effect_from_json, update_effect
+    from main import startup
+
+    settings._loaded = True  # The default settings
+    startup()
+
+    start_effect_from_json('{"effect": "xmastree"}')
+    tree = effects._current_effect
+    assert start_effect_from_json('{"effect": "xmastree", "color": "(255,0,0)", "wait": 50}')
+    assert effects._current_effect is tree, "color update restarted xmastree"
+    assert tree._color == (255, 0, 0) and tree._wait == 50
+
+    # Rainbow cannot change a color in place: the command restarts it.
+    start_effect_from_json('{"effect": "rainbow"}')
+    rainbow = effects._current_effect
+    start_effect_from_json('{"effect": "rainbow", "color": "(255,0,0)"}')
+    assert effects._current_effect is not rainbow, "rainbow not restarted"
+    rainbow = effects._current_effect
+    assert update_effect({"color": "(0,0,255)"}) is False
+    assert effects._current_effect is rainbow
+    assert update_effect({"wait": 40}) is True
+    print("test_update passed")
+
+
+if __name__ == "__main__":
+    test_update()
@@ -0,0 +1,45 @@
+"""
+test_wait.py - Test that effects run with a float wait, as JSON commands may send one, e.g.
+{"effect": "blink", "wait": 100.0}. The frame scheduler needs the wait as an int.
+
+Runs on the host from the src directory, with the board simulation of test_async.py:
+    python3 tests/test_wait.py
+or on the board: mpremote run tests/test_wait.py
+"""
+
+import sys
+
+sys.path.insert(0, "")  # The src directory, the current directory when run as documented
+sys.path.append("lib")
+sys.path.append("tests")
+
+
+def test_wait():
+    try:
+        from test_async import _simulate_board
+
+        _simulate_board()
+    except ImportError:
+        pass  # On the board
+    import time
+
+    import settings
+    from effects import effect_loop, effect_time_to_next, start_effect_from_json
+    from main import startup
+
+    settings._loaded = True  # The default settings
+    startup()
+    for name in ("blink", "cross", "xmastree"):
+        assert start_effect_from_json('{"effect": "%s", "wait": 20.0}' % name), name
+        for _ in range(3):
+            effect_loop()
+            assert isinstance(effect_time_to_next(), int), name
+            time.sleep_ms(20)
+        # A float wait in an update of the running effect
+        assert start_effect_from_json('{"effect": "%s", "wait": 30.5}' % name), name
+        effect_loop()
+    print("test_wait passed")
+
+
+if __name__ == "__main__":
+    test_wait()
@@ -0,0 +1,135 @@
+"""
+test_wifi.py - Test of the WiFi station selection in connectivity.py against a fake network.WLAN.
+
+Runs on the MicroPython unix port from the src directory:
+    micropython tests/test_wifi.py
+
+It removes the saved WiFi network (wifi.json), so do not run it on a board. The fake network
+module is installed before connectivity is imported. Its WLAN scans the networks in RANGE and
+connects only to those, on any of their access points unless a BSSID is given.
+"""
+
+import sys
+
+sys.path.insert(0, "")  # The src directory, the current directory when run as documented
+sys.path.append("lib")
+
+
+class FakeWLAN:
+    RANGE = {}  # ssid -> list of (bssid, channel, rssi) of the access points in range
+
+    def __init__(self, interface):
+        self._active = False
+        self._connected = False
+        self._status = network.STAT_IDLE
+        self.attempts = []  # The (ssid, bssid) of all connect() calls
+        self.scans = 0
+
+    def active(self, active=None):
+        if active is None:
+            return self._active
+        self._active = active
+        if not active:
+            self._connected = False
+
+    def scan(self):
+        self.scans += 1
+        return [
+            (ssid.encode(), bssid, channel, rssi, 3, False)
+            for ssid, aps in self.RANGE.items()
+            for bssid, channel, rssi in aps
+        ]
+
+    def connect(self, ssid, passwd, bssid=None):
+        self.attempts.append((ssid, bssid))
+        aps = [ap[0] for ap in self.RANGE.get(ssid, ())]
+        self._connected = bool(aps) and (bssid is None or bssid in aps)
+        self._status = network.STAT_GOT_IP if self._connected else network.STAT_NO_AP_FOUND
+
+    def isconnected(self):
+        return self._connected
+
+    def status(self, *args):
+        return self._status
+
+    def ifconfig(self):
+        return ("10.0.0.2" if self._connected else "0.0.0.0", "", "", "")
+
+    def config(self, *args, **kwargs):
+        pass
+
+
+class FakeModule:
+    pass
+
+
+network = FakeModule()
+network.STA_IF, network.AP_IF, network.AUTH_WPA_WPA2_PSK = 0, 1, 3
+network.STAT_IDLE, network.STAT_GOT_IP = 1000, 1010
+network.STAT_NO_AP_FOUND, network.STAT_WRONG_PASSWORD, network.STAT_CONNECT_FAIL = 201, 202, 203
+network.WLAN = FakeWLAN
+sys.modules["network"] = network
+sys.modules["ntptime"] = FakeModule()
+
+import connectivity
+import settings
+from os import remove
+
+STATIONS = '[("home", "pw1"), ("office", "pw2"), ("shed", "pw3")]'
+
+
+def start(scan):
+    """Connect with the given wifi_scan setting and return the ssid connected to."""
+    settings._loaded = True
+    settings._settings.update({"wifi_stations": STATIONS, "wifi_scan": "1" if scan else "0"})
+    connectivity._wifi_sta.attempts = []
+    connectivity.wifi_start(reconnect=True)
+    while connectivity.wifi_poll() == connectivity.WIFI_CONNECTING:
+        pass
+    return connectivity.wifi_stats()["ssid"]
+
+
+def test_wifi():
+    sta = connectivity._wifi_sta
+    try:
+        remove(connectivity.WIFI_CACHE_FILE)
+    except OSError:
+        pass
+    FakeWLAN.RANGE = {
+        "office": [(b"\x01" * 6, 1, -80), (b"\x02" * 6, 6, -60)],
+        "shed": [(b"\x03" * 6, 11, -70)],
+        "neighbour": [(b"\x04" * 6, 1, -30)],
+    }
+
+    # Settings order tries home first, which is not in range.
+    assert start(scan=False) == "office"
+    assert sta.attempts == [("home", None), ("office", None)], sta.attempts
+    assert sta.scans == 0
+
+    # Scan mode goes straight to the strongest configured access point.
+    assert start(scan=True) == "office"
+    assert sta.attempts == [("office", b"\x02" * 6)], sta.attempts
+    assert sta.scans == 1
+
+    # The next start reconnects to the saved network without scanning.
+    assert start(scan=True) == "office"
+    assert sta.attempts == [("office", b"\x02" * 6)], sta.attempts
+    assert sta.scans == 1
+
+    # When the saved access point is gone, scan and use the next best one.
+    FakeWLAN.RANGE["office"] = [(b"\x01" * 6, 1, -80)]
+    FakeWLAN.RANGE["shed"] = [(b"\x03" * 6, 11, -50)]
+    assert start(scan=True) == "shed"
+    assert sta.attempts == [("office", b"\x02" * 6), ("shed", b"\x03" * 6)], sta.attempts
+    assert sta.scans == 2
+
+    # Nothing configured in range: fall back to the access point.
+    FakeWLAN.RANGE = {"neighbour": [(b"\x04" * 6, 1, -30)]}
+    start(scan=True)
+    assert connectivity.wifi_state() == connectivity.WIFI_AP
+    remove(connectivity.WIFI_CACHE_FILE)
+    print("test_wifi passed")
+
+
+if __name__ == "__main__":
+    test_wifi()